@@ -13,6 +13,8 @@ from corelib.flask import Flask
 from corelib.utils import update_url_query
 from corelib.exmail import send_mail_task as _send_mail_task
 from forms import ExtendedLoginForm, ExtendedRegisterForm
+from models.loader import card_state, user_state
+from models.fragment import fragment, slot, fill_slots
 from views import index, account
 from views.api import json_api as api
 
@@ -31,6 +33,11 @@ def _inject_template_global(app):
     app.add_template_global(hasattr)
     app.add_template_global(current_user)
     app.add_template_global(update_url_query)
+    app.add_template_global(card_state)
+    app.add_template_global(user_state)
+    app.add_template_global(fragment)
+    app.add_template_global(slot)
+    app.add_template_filter(fill_slots)
 
 
 def create_app():
@@ -0,0 +1,115 @@
+"""
+首页合并热门分享时Redis的CPU占用: 改造前(每个用户每5分钟读出全部热门文章再`ZADD`回去)
+和现在(Lua脚本按序号水位只合并新的热门文章)。模拟`--users`个活跃用户，
+每轮加入`--new`篇热门文章，每个用户每轮访问`--views`次首页，改造前假设每轮间隔超过5分钟。
+需要一个空的Redis库(默认`REDIS_URL`的15号库)，测完会清空它
+
+    python benchmarks/bench_activity_merge.py [--users 10000] [--rounds 6]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis  # noqa
+
+from config import REDIS_URL, FEED_MAX_LENGTH, FEED_INACTIVE_TTL  # noqa
+from corelib.consts import ONE_MINUTE  # noqa
+from models.feed import (  # noqa
+    MAX, FEED_KEY, FEED_READY_KEY, FEED_AUTHORS_KEY, ACTIVITY_KEY,
+    ACTIVITY_SEQ_KEY, ACTIVITY_COUNTER_KEY, ACTIVITY_WATERMARK_KEY,
+    ACTIVITY_AUTHORS_KEY, _add_activity, _merge_activity)
+
+LEGACY_UPDATED_KEY = 'feed:activity_updated:{}'
+BATCH = 500
+AUTHOR_ID = 1
+
+
+def legacy_view(client, user_ids):
+    """ 改造前`get_user_feed`里合并热门分享的部分 """
+    pipe = client.pipeline(transaction=False)
+    for id in user_ids:
+        pipe.get(LEGACY_UPDATED_KEY.format(id))
+    need = [id for id, r in zip(user_ids, pipe.execute()) if not r]
+    items = client.zrange(ACTIVITY_KEY, 0, -1, withscores=True) \
+        if need else []
+    for id in need:
+        if items:
+            pipe.zadd(FEED_KEY.format(id), dict(items))
+        pipe.set(LEGACY_UPDATED_KEY.format(id), 1, ex=ONE_MINUTE * 5)
+    pipe.execute()
+
+
+def merge_view(client, user_ids):
+    pipe = client.pipeline(transaction=False)
+    for id in user_ids:
+        _merge_activity(keys=[
+            ACTIVITY_KEY, ACTIVITY_SEQ_KEY, ACTIVITY_COUNTER_KEY,
+            FEED_KEY.format(id), FEED_READY_KEY.format(id),
+            ACTIVITY_WATERMARK_KEY.format(id), ACTIVITY_AUTHORS_KEY,
+            FEED_AUTHORS_KEY.format(id)], args=[FEED_MAX_LENGTH],
+            client=pipe)
+    pipe.execute()
+
+
+def redis_cpu(client):
+    info = client.info('cpu')
+    return info['used_cpu_sys'] + info['used_cpu_user']
+
+
+def add_activity(client, score, post_id):
+    _add_activity(keys=[ACTIVITY_KEY, ACTIVITY_SEQ_KEY, ACTIVITY_COUNTER_KEY,
+                        ACTIVITY_AUTHORS_KEY],
+                  args=[score, post_id, MAX, AUTHOR_ID], client=client)
+
+
+def run(client, view, args):
+    client.flushdb()
+    for post_id in range(-MAX, 0):  # 先放满热门分享，和线上一样
+        add_activity(client, post_id, post_id)
+    pipe = client.pipeline(transaction=False)
+    for id in range(1, args.users + 1):
+        pipe.set(FEED_READY_KEY.format(id), 1, ex=FEED_INACTIVE_TTL)
+    pipe.execute()
+
+    post_id, cpu, elapsed = 0, 0, 0
+    for _ in range(args.rounds):
+        for _ in range(args.new):
+            post_id += 1
+            add_activity(client, -post_id, post_id)
+        for key in client.scan_iter('feed:activity_updated:*'):
+            client.delete(key)  # 改造前的标记每轮都已过期
+        cpu_start, start = redis_cpu(client), time.perf_counter()
+        for _ in range(args.views):
+            for i in range(1, args.users + 1, BATCH):
+                view(client, list(range(
+                    i, min(i + BATCH, args.users + 1))))
+        elapsed += time.perf_counter() - start
+        cpu += redis_cpu(client) - cpu_start
+    client.flushdb()
+    return cpu, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=6)
+    parser.add_argument('--new', type=int, default=2)
+    parser.add_argument('--views', type=int, default=3)
+    parser.add_argument('--db', type=int, default=15)
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(REDIS_URL, db=args.db)
+    if client.dbsize():
+        sys.exit(f'Redis db {args.db} is not empty')
+
+    for name, view in (('legacy', legacy_view), ('watermark', merge_view)):
+        cpu, elapsed = run(client, view, args)
+        print(f'{name:>9}: redis cpu {cpu:7.2f} s, '
+              f'wall {elapsed:7.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+对比`sqlalchemy.ext.serializer`和`corelib.codec`缓存`Post`、`User`和`Pagination`时
+每条数据的大小和反序列化耗时
+
+    python benchmarks/bench_codec.py [--number 20000]
+"""
+import os
+import sys
+import timeit
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_sqlalchemy import Pagination  # noqa
+from sqlalchemy.orm import make_transient_to_detached  # noqa
+from sqlalchemy.ext.serializer import dumps, loads  # noqa
+
+from corelib.codec import encode, decode  # noqa
+from models.core import Post  # noqa
+from models.user import User  # noqa
+
+
+def detached(cls, **kwargs):
+    """ 模拟从数据库读出的对象，所有列都已加载 """
+    values = {prop.key: None for prop in cls.__mapper__.column_attrs}
+    values.update(kwargs)
+    obj = cls(**values)
+    make_transient_to_detached(obj)
+    return obj
+
+
+def make_post(id):
+    return detached(Post, id=id, author_id=1,
+                    title='从 Python 的 GIL 说起 %d' % id,
+                    orig_url='https://coolshell.cn/articles/%d.html' % id,
+                    can_comment=True, created_at=datetime(2019, 5, 1, 8, 30))
+
+
+def make_user(id):
+    return detached(User, id=id, name='admin', nickname='admin',
+                    bio='Pythonista', email='admin@example.com',
+                    password='$6$rounds=656000$' * 4,
+                    website='https://example.com', active=True,
+                    login_count=42, github_url='https://github.com/admin',
+                    icon_color='#336699', created_at=datetime(2019, 5, 1),
+                    avatar_id='5cc8a3b2f1c2a0')
+
+
+def samples():
+    yield 'Post', make_post(1)
+    yield 'User', make_user(1)
+    yield 'Pagination[Post]', Pagination(None, 1, 2, 100,
+                                         [make_post(1), make_post(2)])
+    yield 'Pagination[id]', Pagination(None, 1, 20, 1000, list(range(20)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f'{"":>18} {"pickle bytes":>12} {"codec bytes":>12} '
+          f'{"pickle us":>10} {"codec us":>10}')
+    for name, obj in samples():
+        old, new = dumps(obj), encode(obj)
+        t_old = timeit.timeit(lambda: loads(old), number=args.number)
+        t_new = timeit.timeit(lambda: decode(new), number=args.number)
+        print(f'{name:>18} {len(old):>12} {len(new):>12} '
+              f'{t_old / args.number * 1e6:>10.1f} '
+              f'{t_new / args.number * 1e6:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
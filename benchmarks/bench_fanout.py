@@ -0,0 +1,131 @@
+"""
+`feed_post_to_followers`的分发耗时和关注者数量的关系:
+改造前(`PER_PAGE`条一页`paginate`读取关注者，每个关注者`ZADD`+`SET`各一次往返)
+和现在(`idx_to_time_from`游标分批读取，每`FANOUT_BATCH`个关注者一次pipeline)。
+关注关系存在SQLite内存数据库；Redis使用`REDIS_URL`的15号库(必须是空的，测完会清空)，
+连不上Redis时只统计读取关注者的耗时和Redis往返次数
+
+    python benchmarks/bench_fanout.py [--followers 1000,10000,100000]
+"""
+import os
+import sys
+import math
+import time
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis  # noqa
+from sqlalchemy import create_engine, select, func, and_, or_  # noqa
+
+from config import PER_PAGE, REDIS_URL  # noqa
+from models.contact import Contact  # noqa
+from models.feed import FEED_KEY, LAST_VISIT_KEY, FANOUT_BATCH  # noqa
+
+AUTHOR_ID = 1
+POST_ID = 1
+SCORE = -int(time.time())
+c = Contact.__table__.c
+
+
+def setup(n_followers):
+    engine = create_engine('sqlite://')
+    Contact.__table__.create(engine)
+    start = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(Contact.__table__.insert(), [
+            {'from_id': i, 'to_id': AUTHOR_ID,
+             'created_at': start + timedelta(seconds=i)}
+            for i in range(2, n_followers + 2)])
+    return engine
+
+
+def legacy_followers(conn):
+    """ 改造前的`gen_followers`，每页一次`paginate`(`LIMIT/OFFSET` + `COUNT`) """
+    total = conn.execute(select([func.count()]).where(
+        c.to_id == AUTHOR_ID)).scalar()
+    for page in range(1, math.ceil(total / PER_PAGE) + 1):
+        conn.execute(select([func.count()]).where(c.to_id == AUTHOR_ID))
+        yield [id for id, in conn.execute(select([c.from_id]).where(
+            c.to_id == AUTHOR_ID).limit(PER_PAGE).offset(
+                PER_PAGE * (page - 1)))]
+
+
+def keyset_followers(conn):
+    """ 关系图不可用时的`Contact.iter_follower_ids` """
+    last = None
+    while True:
+        cond = c.to_id == AUTHOR_ID
+        if last:
+            cond = and_(cond, or_(c.created_at < last[0], and_(
+                c.created_at == last[0], c.from_id < last[1])))
+        rows = conn.execute(select([c.created_at, c.from_id]).where(
+            cond).order_by(c.created_at.desc(), c.from_id.desc()).limit(
+                FANOUT_BATCH)).fetchall()
+        if not rows:
+            return
+        yield [from_id for _, from_id in rows]
+        last = rows[-1]
+
+
+def legacy_push(client, from_ids):
+    for from_id in from_ids:
+        client.zadd(FEED_KEY.format(from_id), {POST_ID: SCORE})
+        client.set(LAST_VISIT_KEY.format(AUTHOR_ID, from_id), POST_ID)
+    return len(from_ids) * 2
+
+
+def pipelined_push(client, from_ids):
+    pipe = client.pipeline(transaction=False)
+    for from_id in from_ids:
+        pipe.zadd(FEED_KEY.format(from_id), {POST_ID: SCORE})
+        pipe.set(LAST_VISIT_KEY.format(AUTHOR_ID, from_id), POST_ID)
+    pipe.execute()
+    return 1
+
+
+def fanout(conn, client, followers, push):
+    start = time.perf_counter()
+    round_trips = 0
+    for from_ids in followers(conn):
+        round_trips += push(client, from_ids) if client else (
+            len(from_ids) * 2 if push is legacy_push else 1)
+    if client:
+        client.flushdb()
+    return (time.perf_counter() - start) * 1e3, round_trips
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--followers', default='1000,10000,100000')
+    parser.add_argument('--legacy-max', type=int, default=10000,
+                        help='改造前的分页读取是O(n^2)，只测不超过这个数量的情况')
+    parser.add_argument('--db', type=int, default=15)
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(REDIS_URL, db=args.db)
+    try:
+        if client.dbsize():
+            sys.exit(f'Redis db {args.db} is not empty')
+    except redis.ConnectionError:
+        print('Redis is not available, skip Redis writes')
+        client = None
+
+    for n in map(int, args.followers.split(',')):
+        engine = setup(n)
+        with engine.connect() as conn:
+            ms_new, rt_new = fanout(conn, client, keyset_followers,
+                                    pipelined_push)
+            line = (f'{n:>8} followers: keyset+pipeline {ms_new:9.1f} ms '
+                    f'({rt_new} round trips)')
+            if n <= args.legacy_max:
+                ms_old, rt_old = fanout(conn, client, legacy_followers,
+                                        legacy_push)
+                line += (f', legacy {ms_old:9.1f} ms '
+                         f'({rt_old} round trips)')
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+对比旧版`LocalCache`(满了就全部清空)和LRU版本在Zipf分布访问下的命中率和查询开销
+
+    python benchmarks/bench_local_cache.py [--keys 100000] [--ops 1000000]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corelib.local_cache import LocalCache, sizeof, ENTRY_OVERHEAD  # noqa
+
+
+class LegacyLocalCache(object):
+    """ 改造前的实现，达到`size`条就整体清空 """
+    def __init__(self, size=10000):
+        self.dataset = {}
+        self.size = size
+
+    def get(self, key):
+        return self.dataset.get(key)
+
+    def set(self, key, value, time=0):
+        if len(self.dataset) >= self.size:
+            self.dataset.clear()
+        self.dataset[key] = value
+
+
+def zipf_trace(n_keys, n_ops, s, seed):
+    rnd = random.Random(seed)
+    cum_weights = list(accumulate(1 / (k ** s) for k in range(1, n_keys + 1)))
+    ranks = rnd.choices(range(n_keys), cum_weights=cum_weights, k=n_ops)
+    return ['__/bran/Post/%d/props_cached' % r for r in ranks]
+
+
+def run(cache, trace, value):
+    hits = 0
+    get, set_ = cache.get, cache.set
+    start = time.perf_counter()
+    for key in trace:
+        if get(key) is None:
+            set_(key, value)
+        else:
+            hits += 1
+    elapsed = time.perf_counter() - start
+    return hits / len(trace), elapsed / len(trace) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--ops', type=int, default=1000000)
+    parser.add_argument('--capacity', type=int, default=10000,
+                        help='旧版的条数上限，新版按相同条数折算成bytes')
+    parser.add_argument('--zipf', type=float, default=1.0)
+    args = parser.parse_args()
+
+    value = {'content': 'x' * 512}
+    trace = zipf_trace(args.keys, args.ops, args.zipf, seed=42)
+    entry_bytes = sizeof(trace[0]) + sizeof(value) + ENTRY_OVERHEAD
+
+    print(f'keys={args.keys} ops={args.ops} zipf={args.zipf} '
+          f'capacity={args.capacity} entries (~{entry_bytes} bytes each)')
+    for name, cache in (
+            ('legacy clear-all', LegacyLocalCache(args.capacity)),
+            ('lru', LocalCache(args.capacity * entry_bytes))):
+        hit_rate, ns = run(cache, trace, value)
+        print(f'{name:>16}: hit rate {hit_rate:.2%}, {ns:.0f} ns/op')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+`@cache`在缓存命中时的单次调用开销: 改造前(`gen_key_factory` + pickle)和现在的对比，
+Redis用进程内字典代替，只统计Python侧的开销
+
+    python benchmarks/bench_mc_key.py [--number 200000]
+"""
+import os
+import sys
+import timeit
+import argparse
+from functools import wraps
+from pickle import UnpicklingError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.ext.serializer import loads  # noqa
+
+from corelib import mc  # noqa
+from corelib.utils import Empty  # noqa
+
+KEY_PATTERN = 'actionmixin:ActionMixin:get_count_by_target(%s,%s,%s)' % (
+    '{cls.action_type}', '{target_id}', '{target_kind}')
+
+
+class FakeRedis(dict):
+    def get(self, key):
+        return dict.get(self, key)
+
+
+def legacy_cache(key_pattern):
+    """ 改造前的`cache`命中路径 """
+    def deco(f):
+        arg_names, varargs, varkw, defaults = mc.getargspec(f)
+        gen_key = mc.gen_key_factory(key_pattern, arg_names, defaults)
+
+        @wraps(f)
+        def _(*a, **kw):
+            key, args = gen_key(*a, **kw)
+            if not key:
+                return f(*a, **kw)
+            kw.pop('force', False)
+            r = mc.rdb.get(key)
+            try:
+                r = loads(r)
+            except (TypeError, UnpicklingError):
+                pass
+            if isinstance(r, Empty):
+                r = None
+            return r
+        return _
+    return deco
+
+
+class LikeItem:
+    action_type = 'like'
+
+    @classmethod
+    @legacy_cache(KEY_PATTERN)
+    def legacy_count(cls, target_id, target_kind):
+        raise AssertionError('should be a cache hit')
+
+    @classmethod
+    @mc.cache(KEY_PATTERN)
+    def count(cls, target_id, target_kind):
+        raise AssertionError('should be a cache hit')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=200000)
+    args = parser.parse_args()
+
+    mc.rdb = FakeRedis({
+        'actionmixin:ActionMixin:get_count_by_target(like,1,1001)': b'42'})
+    legacy_gen = mc.gen_key_factory(KEY_PATTERN,
+                                    ['cls', 'target_id', 'target_kind'], None)
+    build = mc.key_builder(KEY_PATTERN,
+                           ['cls', 'target_id', 'target_kind'], None)
+    assert legacy_gen(LikeItem, 1, 1001)[0] == build(LikeItem, 1, 1001)
+    assert LikeItem.legacy_count(1, 1001) == LikeItem.count(1, 1001)
+
+    for name, func in (
+            ('key: gen_key_factory', lambda: legacy_gen(LikeItem, 1, 1001)),
+            ('key: key_builder', lambda: build(LikeItem, 1, 1001)),
+            ('hit: before', lambda: LikeItem.legacy_count(1, 1001)),
+            ('hit: after', lambda: LikeItem.count(1, 1001))):
+        t = timeit.timeit(func, number=args.number)
+        print(f'{name:>22}: {t / args.number * 1e9:.0f} ns/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+每100万个like占用的Redis内存: 改造前每个(用户, 文章)缓存一条`get_by_target`的记录，
+现在每篇文章一个用户id集合(`MC_KEY_MEMBERS`)。
+需要一个空的Redis库(默认`REDIS_URL`的15号库)，测完会清空它；
+连不上Redis时只输出每条数据的字节数
+
+    python benchmarks/bench_membership_memory.py [--likes N] [--posts N]
+"""
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis  # noqa
+from sqlalchemy.orm import make_transient_to_detached  # noqa
+
+from config import REDIS_URL  # noqa
+from corelib.codec import encode  # noqa
+from corelib.consts import K_POST  # noqa
+from models.like import LikeItem  # noqa
+from models.actionmixin import MC_KEY_MEMBERS, MEMBERS_LOADED  # noqa
+
+LEGACY_KEY = 'actionmixin:ActionMixin:get_by_target(%s,%s,%s,%s)'
+BATCH = 10000
+
+
+def like_item(id, user_id, post_id):
+    obj = LikeItem(id=id, user_id=user_id, target_id=post_id,
+                   target_kind=K_POST, created_at=None, updated_at=None)
+    make_transient_to_detached(obj)
+    return obj
+
+
+def gen_likes(n_likes, n_posts, n_users, seed=0):
+    """ 热门文章的like更多: 文章按Zipf分布抽样，同一对(用户, 文章)只算一次 """
+    rnd = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(n_posts)]
+    seen = set()
+    while len(seen) < n_likes:
+        posts = rnd.choices(range(1, n_posts + 1), weights, k=BATCH)
+        for post_id in posts:
+            seen.add((rnd.randint(1, n_users), post_id))
+            if len(seen) == n_likes:
+                break
+    return sorted(seen)
+
+
+def write_legacy(pipe, likes):
+    for i, (user_id, post_id) in enumerate(likes, 1):
+        pipe.set(LEGACY_KEY % ('like', user_id, post_id, K_POST),
+                 encode(like_item(i, user_id, post_id)))
+        if i % BATCH == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def write_members(pipe, likes):
+    members = {}
+    for user_id, post_id in likes:
+        members.setdefault(post_id, [MEMBERS_LOADED]).append(user_id)
+    for i, (post_id, user_ids) in enumerate(members.items(), 1):
+        pipe.sadd(MC_KEY_MEMBERS % ('like', post_id, K_POST), *user_ids)
+        if i % 100 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def used_memory(client, write, likes):
+    client.flushdb()
+    before = client.info('memory')['used_memory']
+    write(client.pipeline(transaction=False), likes)
+    after = client.info('memory')['used_memory']
+    client.flushdb()
+    return after - before
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--likes', type=int, default=1000000)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--db', type=int, default=15)
+    args = parser.parse_args()
+
+    key = LEGACY_KEY % ('like', args.users, args.posts, K_POST)
+    value = encode(like_item(args.likes, args.users, args.posts))
+    print(f'legacy payload: {len(key) + len(value)} bytes/like '
+          f'(key {len(key)}, value {len(value)})')
+
+    client = redis.Redis.from_url(REDIS_URL, db=args.db)
+    try:
+        if client.dbsize():
+            sys.exit(f'Redis db {args.db} is not empty')
+    except redis.ConnectionError:
+        print('Redis is not available, skip measuring used_memory')
+        return
+
+    likes = gen_likes(args.likes, args.posts, args.users)
+    scale = 1e6 / len(likes)
+    legacy = used_memory(client, write_legacy, likes)
+    members = used_memory(client, write_members, likes)
+    print(f'{len(likes)} likes on {args.posts} posts')
+    print(f'legacy:  {legacy * scale / 2 ** 20:8.1f} MiB per 1M likes')
+    print(f'members: {members * scale / 2 ** 20:8.1f} MiB per 1M likes')
+
+
+if __name__ == '__main__':
+    main()
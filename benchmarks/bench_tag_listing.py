@@ -0,0 +1,100 @@
+"""
+标签下有10万篇文章时，改造前(先取出全部post id再`IN`查询，数量再`COUNT`一次)
+和现在(`JOIN` + `idx_tag_post`有序`LIMIT`，数量取自计数缓存)缓存未命中时的耗时，
+使用SQLite内存数据库
+
+    python benchmarks/bench_tag_listing.py [--posts 100000] [--repeat 20]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, select, func, text  # noqa
+
+from config import PER_PAGE  # noqa
+from models.core import Post, PostTag  # noqa
+
+TAG_ID = 1
+
+
+def setup(n_posts):
+    engine = create_engine('sqlite://')
+    Post.__table__.create(engine)
+    PostTag.__table__.create(engine)
+    with engine.begin() as conn:
+        conn.execute(Post.__table__.insert(), [
+            {'id': i, 'author_id': 1, 'title': 'post %d' % i}
+            for i in range(1, n_posts + 1)])
+        conn.execute(PostTag.__table__.insert(), [
+            {'post_id': i, 'tag_id': TAG_ID} for i in range(1, n_posts + 1)])
+    return engine
+
+
+def legacy_page(conn, page):
+    """ 改造前的`_get_posts_by_tag` + `paginate` """
+    post_ids = conn.execute(select([PostTag.post_id]).where(
+        PostTag.tag_id == TAG_ID)).fetchall()
+    in_list = ','.join(str(id) for id, in post_ids)  # pymysql同样在客户端拼接参数
+    ids = conn.execute(text(
+        'SELECT id FROM posts WHERE id IN (%s) ORDER BY id DESC '
+        'LIMIT %d OFFSET %d' % (in_list, PER_PAGE, PER_PAGE * (page - 1))
+    )).fetchall()
+    total = conn.execute(text(
+        'SELECT count(*) FROM (SELECT id FROM posts WHERE id IN (%s))'
+        % in_list)).scalar()
+    return [id for id, in ids], total
+
+
+def join_page(conn, page):
+    """ 现在的`_get_post_ids_query`，数量来自计数缓存，不查询数据库 """
+    ids = conn.execute(select([PostTag.post_id]).select_from(
+        PostTag.__table__.join(Post.__table__, Post.id == PostTag.post_id)
+    ).where(PostTag.tag_id == TAG_ID).order_by(PostTag.post_id.desc()).limit(
+        PER_PAGE).offset(PER_PAGE * (page - 1))).fetchall()
+    return [id for id, in ids]
+
+
+def count_on_miss(conn):
+    """ 计数缓存失效时的统计 """
+    return conn.execute(select([func.count(PostTag.id)]).where(
+        PostTag.tag_id == TAG_ID)).scalar()
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        r = func()
+    return (time.perf_counter() - start) / repeat * 1e3, r
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    engine = setup(args.posts)
+    with engine.connect() as conn:
+        plan = conn.execute(text('EXPLAIN QUERY PLAN ' + str(
+            select([PostTag.post_id]).where(PostTag.tag_id == TAG_ID)
+            .order_by(PostTag.post_id.desc()).limit(PER_PAGE).compile(
+                compile_kwargs={'literal_binds': True})))).fetchall()
+        print('plan:', '; '.join(row[-1] for row in plan))
+
+        for page in (1, 100):
+            ms_old, (old_ids, total) = timed(
+                lambda: legacy_page(conn, page), args.repeat)
+            ms_new, new_ids = timed(lambda: join_page(conn, page),
+                                    args.repeat)
+            assert old_ids == new_ids and total == args.posts
+            print(f'page {page:>3}: legacy {ms_old:8.2f} ms, '
+                  f'join {ms_new:8.2f} ms')
+        ms, total = timed(lambda: count_on_miss(conn), args.repeat)
+        print(f'count on counter miss: {ms:.2f} ms ({total} rows)')
+
+
+if __name__ == '__main__':
+    main()
@@ -52,6 +52,12 @@ CELERY_TASK_SERIALIZER = 'msgpack'  # 任务序列化和反序列化使用msgpac
 CELERY_RESULT_SERIALIZER = 'json'  # 读取任务结果一般性能要求不高，所以使用了可读性更好的JSON
 CELERY_TASK_RESULT_EXPIRES = 60 * 60 * 24  # 任务过期时间，不建议直接写86400，应该让这样的magic数字表述更明显 # noqa
 CELERY_ACCEPT_CONTENT = ['json', 'msgpack']  # 指定接受的内容类型
+CELERYBEAT_SCHEDULE = {  # 定时任务，需要启动`celery beat -A handler.celery`
+    'flush-action-counters': {
+        'task': 'handler.tasks.flush_action_counters',
+        'schedule': 10,  # 每10秒把计数增量写入数据库
+    },
+}
 
 # Email
 SMTP_HOST = 'smtp.qq.com'
@@ -64,6 +70,14 @@ ES_HOSTS = ['localhost']
 
 PER_PAGE = 2
 
+FEED_PUSH_THRESHOLD = 10000  # 关注者达到这个数量的作者不再推送文章，由关注者读取时从作者时间线拉取
+FEED_MERGE_TTL = 30  # 推拉合并后的feed缓存秒数
+FEED_MAX_LENGTH = 1000  # 每个用户的feed流最多保留的文章数量
+FEED_INACTIVE_TTL = 60 * 60 * 24 * 30  # 用户这么久没有读取feed流就删除，回来时再重建
+FEED_REBUILD_SYNC = 50  # feed流重建完成前，首页同步查询的文章数量上限
+
+MC_DELAYED_DELETE = 0  # 事务提交后隔几秒再删一次缓存，清理并发读回填的旧数据，0表示不启用
+
 HERE = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_FOLDER = os.path.join(HERE, 'permdir')
 if not os.path.exists(UPLOAD_FOLDER):
@@ -0,0 +1,143 @@
+"""
+缓存数据的编解码
+
+model实例只保存列值元组及其schema版本(由列名计算)，读取时重建成detached的实例，
+model增删列后schema版本变化，旧缓存会被当作未命中重新计算，而不是反序列化失败。
+`Pagination`、`CursorPage`、id列表等也用msgpack保存，无法识别的对象才退回到pickle。
+
+整数、字符串等原样存储，`incr_key`可以直接在缓存上增减。
+"""
+import zlib
+import struct
+from datetime import datetime
+from pickle import UnpicklingError
+
+import msgpack
+from flask_sqlalchemy import Pagination
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.ext.serializer import loads as pickle_loads, \
+    dumps as pickle_dumps  # 兼容旧的缓存数据，以及无法识别的对象
+
+from corelib.utils import Empty, empty, CursorPage
+
+MAGIC = b'\xc1'  # msgpack里没有使用的字节，用来区分原样存储的值和旧的pickle数据
+PICKLE_PROTO = b'\x80'  # 旧缓存数据是pickle protocol 2+的格式
+RAW_TYPES = (int, float, str, bytes)
+
+EXT_MODEL = 1
+EXT_DATETIME = 2
+EXT_PAGINATION = 3
+EXT_EMPTY = 4
+EXT_PICKLE = 5
+EXT_CURSOR_PAGE = 6
+
+DATETIME_STRUCT = struct.Struct('>HBBBBBI')  # naive datetime，精确到微秒
+
+__models = {}  # model name -> model class
+__schemas = {}  # model name -> (column keys, schema version)
+
+
+class SchemaChanged(Exception):
+    """ 缓存里的model数据和当前的列定义不一致，调用方应当作未命中处理 """
+
+
+def register_model(cls):
+    __models[cls.__name__] = cls
+
+
+def _schema(cls):
+    name = cls.__name__
+    schema = __schemas.get(name)
+    if schema is None:
+        keys = [prop.key for prop in cls.__mapper__.column_attrs]
+        version = zlib.crc32(','.join(keys).encode('utf-8'))
+        schema = __schemas[name] = (keys, version)
+    return schema
+
+
+def _default(obj):
+    if isinstance(obj, Empty):
+        return msgpack.ExtType(EXT_EMPTY, b'')
+    cls = type(obj)
+    if cls.__name__ in __models and __models[cls.__name__] is cls:
+        keys, version = _schema(cls)
+        d = obj.__dict__
+        data = [cls.__name__, version,
+                [d[k] if k in d else getattr(obj, k) for k in keys]]
+        return msgpack.ExtType(EXT_MODEL, _packb(data))
+    if cls is datetime and obj.tzinfo is None:
+        return msgpack.ExtType(EXT_DATETIME, DATETIME_STRUCT.pack(
+            obj.year, obj.month, obj.day, obj.hour, obj.minute,
+            obj.second, obj.microsecond))
+    if isinstance(obj, Pagination):
+        return msgpack.ExtType(EXT_PAGINATION, _packb(
+            [obj.page, obj.per_page, obj.total, obj.items]))
+    if cls is CursorPage:
+        return msgpack.ExtType(EXT_CURSOR_PAGE, _packb(
+            [obj.items, obj.per_page, obj.next_cursor, obj.cursor,
+             obj.total]))
+    return msgpack.ExtType(EXT_PICKLE, pickle_dumps(obj))
+
+
+def _load_model(name, version, values):
+    cls = __models.get(name)
+    if cls is None:
+        raise SchemaChanged(name)
+    keys, current = _schema(cls)
+    if version != current:
+        raise SchemaChanged(name)
+    obj = cls.__mapper__.class_manager.new_instance()
+    obj.__dict__.update(zip(keys, values))
+    make_transient_to_detached(obj)
+    return obj
+
+
+def _ext_hook(code, data):
+    if code == EXT_MODEL:
+        return _load_model(*_unpackb(data))
+    if code == EXT_DATETIME:
+        return datetime(*DATETIME_STRUCT.unpack(data))
+    if code == EXT_PAGINATION:
+        page, per_page, total, items = _unpackb(data)
+        return Pagination(None, page, per_page, total, items)
+    if code == EXT_CURSOR_PAGE:
+        return CursorPage(*_unpackb(data))
+    if code == EXT_EMPTY:
+        return empty
+    if code == EXT_PICKLE:
+        return pickle_loads(data)
+    return msgpack.ExtType(code, data)
+
+
+def _packb(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def _unpackb(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+
+
+def encode(value):
+    """ `None`存为`empty`，用来缓存"对象不存在" """
+    if value is None:
+        value = empty
+    if type(value) in RAW_TYPES:
+        return value
+    return MAGIC + _packb(value)
+
+
+def decode(data):
+    """ 数据无法使用时抛出`SchemaChanged` """
+    if not isinstance(data, bytes):
+        return data  # 刚计算出来、还没经过Redis的原始值
+    prefix = data[:1]
+    if prefix == MAGIC:
+        return _unpackb(data[1:])
+    if prefix != PICKLE_PROTO:
+        return data  # 原样存储的值
+    try:
+        return pickle_loads(data)
+    except (UnpicklingError, EOFError, ValueError, IndexError, KeyError):
+        return data
+    except (AttributeError, ImportError):
+        raise SchemaChanged('legacy pickle')
@@ -1,18 +1,136 @@
 import copy
 import json
+import time
 from datetime import datetime
 
 from flask_sqlalchemy import SQLAlchemy, Model, DefaultMeta, declarative_base
-from sqlalchemy import Column, DateTime, Integer, event
+from sqlalchemy import (Column, DateTime, Integer, event, and_, or_, case,
+                        func, select)
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import Session, object_session
 from flask import abort
 
+from config import MC_DELAYED_DELETE, PER_PAGE
 from corelib.local_cache import lc
-from corelib.mc import cache
+from corelib.codec import register_model
+from corelib.mc import (cache, cache_multi, evict_l1, register_l1,
+                        ensure_l1_listener, InvalidationBuffer)
+from corelib.consts import ONE_MINUTE
+from corelib.utils import CursorPage, encode_cursor, decode_cursor
 from . import rdb
 
 # obj_type,obj_id  Cached `Model.get(id)`
 MC_KEY_GET_ID = 'db:BaseModel:get(%s,%s)'
+L1_SIZE_GET_ID = 16 * 1024 * 1024
+
+# obj_type,obj_id 对象渲染出的HTML片段的版本号，对象更新时递增
+MC_NS_FRAGMENT = 'fragment:%s(%s)'
+
+register_l1('props', lc)  # props的进程内缓存也要响应其他进程的失效广播
+
+MC_BUFFER = 'mc_buffer'  # `session.info`里缓存失效缓冲区的key
+
+# `manage.py migrate_props`全部迁移完成后设置，之后写入props不再检查旧JSON数据
+PROPS_MIGRATED_KEY = 'props:migrated'
+PROPS_MIGRATED_CHECK = ONE_MINUTE  # 没有迁移完成时，每个进程重新检查的间隔
+
+
+def mc_buffer(target=None):
+    """
+    `target`所在事务(默认是`db.session`)的缓存失效缓冲区，flush钩子里的失效操作
+    都要放到这里，事务提交后一次发送，避免并发读在提交前把旧数据写回缓存
+    """
+    session = target is not None and object_session(target) or db.session()
+    buf = session.info.get(MC_BUFFER)
+    if buf is None:
+        buf = session.info[MC_BUFFER] = InvalidationBuffer()
+    return buf
+
+
+@event.listens_for(Session, 'after_commit')
+def _flush_mc_buffer(session):
+    buf = session.info.pop(MC_BUFFER, None)
+    if not buf:
+        return
+    keys = buf.flush()
+    if keys and MC_DELAYED_DELETE:
+        from handler.tasks import delete_mc
+        delete_mc.apply_async(args=(keys,), countdown=MC_DELAYED_DELETE)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_mc_buffer(session):
+    buf = session.info.pop(MC_BUFFER, None)
+    if buf:
+        buf.discard()
+
+
+def keyset_paginate(query, columns, cursor=None, per_page=PER_PAGE):
+    """
+    按`columns`降序的游标分页，`query`选出的前几列必须就是`columns`，
+    翻页条件展开成`a < x OR (a = x AND b < y)`，能直接利用以`columns`结尾的联合索引，
+    不管翻到第几页都只扫描`per_page + 1`行，也不需要`COUNT(*)`
+    """
+    values = decode_cursor(cursor)
+    if values is not None:
+        if len(values) != len(columns):
+            raise ValueError(cursor)
+        conds, eqs = [], []
+        for column, value in zip(columns, values):
+            conds.append(and_(*eqs, column < value))
+            eqs.append(column == value)
+        query = query.filter(or_(*conds))
+    rows = query.order_by(*(c.desc() for c in columns)).limit(
+        per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][:len(columns)])
+    return CursorPage([tuple(row) for row in rows], per_page, next_cursor,
+                      cursor)
+
+
+def bulk_incr(model, keys, column, rows, version=None):
+    """
+    按唯一键`keys`把每行的`column`累加到`model`对应的表，不存在的行插入。
+    MySQL用一条`INSERT ... ON DUPLICATE KEY UPDATE`写入整批，
+    其他数据库(开发环境)逐行先`UPDATE`再`INSERT`。
+    传入`version=(列名, 版本)`时只累加版本更小的行并写入新版本，
+    同一批重复写入也只累加一次
+    """
+    if not rows:
+        return
+    table = model.__table__
+    c = table.c
+    session = db.session
+    if version is not None:
+        name, value = version
+        rows = [dict(row, **{name: value}) for row in rows]
+    if db.engine.dialect.name == 'mysql':
+        stmt = mysql_insert(table).values(rows)
+        incr = c[column] + stmt.inserted[column]
+        if version is None:
+            session.execute(stmt.on_duplicate_key_update({column: incr}))
+            return
+        # 按顺序赋值，累加时比较的还是旧版本
+        session.execute(stmt.on_duplicate_key_update([
+            (column, case([(c[name] < value, incr)], else_=c[column])),
+            (name, func.greatest(c[name], value))]))
+        return
+    for row in rows:
+        cond = and_(*(c[k] == row[k] for k in keys))
+        values = {column: c[column] + row[column]}
+        where = cond
+        if version is not None:
+            values[name] = value
+            where = and_(cond, c[name] < value)
+        r = session.execute(table.update().where(where).values(values))
+        if r.rowcount:
+            continue
+        if version is None or not session.execute(
+                select([c[keys[0]]]).where(cond)).first():
+            session.execute(table.insert().values(row))
 
 
 class PropsItem:
@@ -53,6 +171,7 @@ class PropsMixin:
         return '%s/props' % self.get_uuid()
 
     def _get_props(self):
+        ensure_l1_listener()
         props = lc.get(self._props_lc_key)
         if props is None:
             props = rdb.get(self._props_db_key) or ''
@@ -62,15 +181,42 @@ class PropsMixin:
 
     def _set_props(self, props):
         """ param `props` is a mapping object """
-        rdb.set(self._props_db_key, json.dumps(props))
-        lc.delete(self._props_lc_key)
+        pipe = rdb.pipeline(transaction=False)
+        pipe.set(self._props_db_key, json.dumps(props))
+        evict_l1(self._props_lc_key, pipe=pipe)
+        pipe.execute()
 
     def _destory_props(self):
-        rdb.delete(self._props_db_key)
-        lc.delete(self._props_lc_key)
+        pipe = rdb.pipeline(transaction=False)
+        pipe.delete(self._props_db_key)
+        evict_l1(self._props_lc_key, pipe=pipe)
+        pipe.execute()
 
     props = property(_get_props, _set_props, _destory_props)
 
+    def _fetch_props(self, pipe):
+        pipe.get(self._props_db_key)
+
+    def _parse_props(self, data):
+        return data and json.loads(data) or {}
+
+    @classmethod
+    def prefetch_props(cls, objs):
+        """
+        用一次pipeline读取多个对象的props并放入本进程缓存，
+        渲染列表时读取`content`等`PropsItem`不再逐个访问Redis
+        """
+        ensure_l1_listener()
+        objs = [obj for obj in objs
+                if obj is not None and lc.get(obj._props_lc_key) is None]
+        if not objs:
+            return
+        pipe = rdb.pipeline(transaction=False)
+        for obj in objs:
+            obj._fetch_props(pipe)
+        for obj, data in zip(objs, pipe.execute()):
+            lc.set(obj._props_lc_key, obj._parse_props(data))
+
     def set_props_item(self, key, value):
         props = self.props
         props[key] = value
@@ -134,6 +280,155 @@ class PropsMixin:
         return True, obj
 
 
+_hdecr_props = rdb.register_script("""
+local n = redis.call('hincrby', KEYS[1], ARGV[1], -1)
+if n < tonumber(ARGV[2]) then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+    return tonumber(ARGV[2])
+end
+return n
+""")
+
+
+_props_migrated = {'done': False, 'checked_at': 0}
+
+
+def props_migrated():
+    """ 旧数据是否已经全部迁移，看到标记后进程内不再读取 """
+    state = _props_migrated
+    if not state['done'] and time.time() - state['checked_at'] >= \
+            PROPS_MIGRATED_CHECK:
+        state['done'] = bool(rdb.exists(PROPS_MIGRATED_KEY))
+        state['checked_at'] = time.time()
+    return state['done']
+
+
+class HashPropsMixin(PropsMixin):
+    """
+    props按字段存在Redis hash里(值为JSON)，读写单个字段不用整体读写，
+    计数用`HINCRBY`原子增减。还没迁移的旧JSON数据在第一次读取或写入时转存过来，
+    写入前必须先转存，否则写入创建的hash会让读取不再去找旧数据；
+    `migrate_props`命令设置`PROPS_MIGRATED_KEY`后，写入只有一次往返
+    """
+    @property
+    def _props_db_key(self):
+        return '%s/props_hash' % self.get_uuid()
+
+    @property
+    def _props_legacy_key(self):
+        return '%s/props' % self.get_uuid()
+
+    @staticmethod
+    def _encode_props(props):
+        return {k: json.dumps(v) for k, v in props.items()}
+
+    @staticmethod
+    def _decode_props(data):
+        return {k.decode() if isinstance(k, bytes) else k: json.loads(v)
+                for k, v in data.items()}
+
+    def _get_props(self):
+        ensure_l1_listener()
+        props = lc.get(self._props_lc_key)
+        if props is None:
+            props = self._parse_props(rdb.hgetall(self._props_db_key))
+            lc.set(self._props_lc_key, props)
+        return props
+
+    def _fetch_props(self, pipe):
+        pipe.hgetall(self._props_db_key)
+
+    def _parse_props(self, data):
+        return self._decode_props(data) or self._migrate_legacy_props()
+
+    def _migrate_legacy_props(self):
+        data = rdb.get(self._props_legacy_key)
+        if data is None:
+            return {}
+        props = json.loads(data) or {}
+        pipe = rdb.pipeline(transaction=True)
+        self._copy_legacy_props(pipe, self._props_db_key, props,
+                                self._props_legacy_key)
+        pipe.execute()
+        return self._decode_props(rdb.hgetall(self._props_db_key))
+
+    @classmethod
+    def _copy_legacy_props(cls, pipe, key, props, legacy_key):
+        """ 用`HSETNX`转存，不会覆盖迁移期间新写入的字段 """
+        for k, v in cls._encode_props(props).items():
+            pipe.hsetnx(key, k, v)
+        pipe.delete(legacy_key)
+
+    def _write_props(self, *commands):
+        """ 转存旧数据后，在一个pipeline里执行`commands`并清理各进程的L1缓存 """
+        if not props_migrated():
+            self._migrate_legacy_props()
+        pipe = rdb.pipeline(transaction=False)
+        for name, *args in commands:
+            getattr(pipe, name)(self._props_db_key, *args)
+        evict_l1(self._props_lc_key, pipe=pipe)
+        return pipe.execute()
+
+    def _set_props(self, props):
+        commands = [('delete',)]
+        if props:
+            commands.append(('hset', None, None, self._encode_props(props)))
+        self._write_props(*commands)
+
+    def _destory_props(self):
+        self._write_props(('delete',))
+
+    props = property(_get_props, _set_props, _destory_props)
+
+    def set_props_item(self, key, value):
+        self._write_props(('hset', key, json.dumps(value)))
+
+    def delete_props_item(self, key):
+        self._write_props(('hdel', key))
+
+    def get_props_item(self, key, default=None):
+        props = lc.get(self._props_lc_key)
+        if props is None:
+            r = rdb.hget(self._props_db_key, key)
+            if r is not None:
+                return json.loads(r)
+            props = self._get_props()  # 可能是还没迁移的旧数据
+        return props.get(key, default)
+
+    def incr_props_item(self, key):
+        return self._write_props(('hincrby', key, 1))[0]
+
+    def decr_props_item(self, key, min=0):
+        if not props_migrated():
+            self._migrate_legacy_props()
+        pipe = rdb.pipeline(transaction=False)
+        _hdecr_props(keys=[self._props_db_key], args=[key, min], client=pipe)
+        evict_l1(self._props_lc_key, pipe=pipe)
+        return pipe.execute()[0]
+
+    def update_props(self, data):
+        if data:
+            self._write_props(('hset', None, None, self._encode_props(data)))
+
+    @classmethod
+    def migrate_props(cls, ids):
+        """ 把`ids`对应的旧JSON数据转存成hash，返回迁移的数量 """
+        objs = [cls(id=id) for id in ids]
+        legacy = rdb.mget([obj._props_legacy_key for obj in objs])
+        pipe = rdb.pipeline(transaction=True)
+        n = 0
+        for obj, data in zip(objs, legacy):
+            if data is None:
+                continue
+            cls._copy_legacy_props(pipe, obj._props_db_key,
+                                   json.loads(data) or {},
+                                   obj._props_legacy_key)
+            n += 1
+        pipe.execute()
+        evict_l1(*(obj._props_lc_key for obj in objs))
+        return n
+
+
 class BaseModel(PropsMixin, Model):
     id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, default=datetime.utcnow())
@@ -148,7 +443,8 @@ class BaseModel(PropsMixin, Model):
         return '<{0} id: {1}>'.format(self.__class__.__name__, self.id)
 
     @classmethod
-    @cache(MC_KEY_GET_ID % ('{cls.__name__}', '{id}'))
+    @cache(MC_KEY_GET_ID % ('{cls.__name__}', '{id}'),
+           l1_size=L1_SIZE_GET_ID, l1_ttl=ONE_MINUTE * 10)
     def get(cls, id):
         return cls.query.get(id)
 
@@ -160,8 +456,15 @@ class BaseModel(PropsMixin, Model):
         return rv
 
     @classmethod
+    @cache_multi(MC_KEY_GET_ID % ('{cls.__name__}', '{id}'),
+                 l1_size=L1_SIZE_GET_ID, l1_ttl=ONE_MINUTE * 10,
+                 normalize=int)
     def get_multi(cls, ids):
-        return [cls.get(id) for id in ids]
+        """
+        和`get`共用缓存，未命中的用一次`IN`查询加载。
+        id统一转换成`int`，`'5'`和`5`读写同一个缓存，不是数字的id返回`None`
+        """
+        return {obj.id: obj for obj in cls.query.filter(cls.id.in_(ids))}
 
     def url(self):
         return '/{}/{}/'.format(self.__class__.__name__.lower(), self.id)
@@ -224,7 +527,8 @@ class BaseModel(PropsMixin, Model):
 
     @classmethod
     def __flush_event__(cls, target):
-        rdb.delete(MC_KEY_GET_ID % (target.__class__.__name__, target.id))
+        mc_buffer(target).delete(
+            MC_KEY_GET_ID % (target.__class__.__name__, target.id))
 
     @classmethod
     def __flush_insert_event__(cls, target):
@@ -253,6 +557,7 @@ class BindDBPropertyMeta(DefaultMeta):
             if isinstance(v, PropsItem):
                 db_columns.append((k, v.default))
         cls._db_columns = db_columns
+        register_model(cls)  # 缓存时按列值元组编码
 
 
 db = SQLAlchemy(model_class=declarative_base(cls=BaseModel,
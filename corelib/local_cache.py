@@ -1,26 +1,93 @@
+import sys
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+ENTRY_OVERHEAD = 120  # OrderedDict节点及entry元组的大致开销(bytes)
+
+
+def sizeof(value, getsizeof=sys.getsizeof):
+    """ 估算对象占用的内存，容器只往下算一层，够用于淘汰判断 """
+    size = getsizeof(value)
+    t = type(value)
+    if t is dict:
+        for v in value.values():
+            size += getsizeof(v)
+    elif t is list or t is tuple or t is set:
+        for v in value:
+            size += getsizeof(v)
+    return size
+
+
 class LocalCache(object):
-    def __init__(self, size=10000):
-        self.dataset = {}
-        self.size = size
+    """
+    进程内的LRU缓存，按估算的内存大小(`max_bytes`)淘汰最久未访问的数据，
+    `set`时指定`time`则该条数据在`time`秒后过期。
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.dataset = OrderedDict()  # key -> (value, expire_at, nbytes)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()  # 只保护写操作，读操作容忍并发删除
 
     def clear(self):
-        self.dataset.clear()
-
-    def _cache(self, key, value):
-        if len(self.dataset) >= self.size:
+        with self._lock:
             self.dataset.clear()
-        self.dataset[key] = value
+            self.nbytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self.dataset),
+                    nbytes=self.nbytes)
+
+    def _cache(self, key, value, time=0):
+        nbytes = sys.getsizeof(key) + sizeof(value) + ENTRY_OVERHEAD
+        if nbytes > self.max_bytes:
+            self._pop(key)
+            return
+        expire_at = monotonic() + time if time else None
+        ds = self.dataset
+        with self._lock:
+            old = ds.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            ds[key] = (value, expire_at, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, n) = ds.popitem(last=False)
+                self.nbytes -= n
+                self.evictions += 1
+
+    def _pop(self, key):
+        with self._lock:
+            entry = self.dataset.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
 
     def __repr__(self):
         return '<LocalCache>'
 
     def get(self, key):
-        return self.dataset.get(key)
+        entry = self.dataset.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expire_at, _ = entry
+        if expire_at is not None and expire_at < monotonic():
+            self._pop(key)
+            self.misses += 1
+            return None
+        try:
+            self.dataset.move_to_end(key)
+        except KeyError:  # 被其他线程删除了
+            pass
+        self.hits += 1
+        return value
 
     def get_multi(self, keys):
-        ds = self.dataset
-        ds_get = ds.get
-        r = {k: ds_get(k) for k in keys}
+        get = self.get
+        r = {k: get(k) for k in keys}
         return r
 
     def get_list(self, keys):
@@ -28,20 +95,20 @@ class LocalCache(object):
         return [rs.get(k) for k in keys]
 
     def set(self, key, value, time=0, compress=True):
-        self._cache(key, value)
+        self._cache(key, value, time)
         return True
 
     def __getattr__(self, name):
         if name in ('add', 'replace', 'delete', 'incr', 'decr', 'prepend',
                     'append'):
             def func(key, *args, **kwargs):
-                self.dataset.pop(key, None)
+                self._pop(key)
                 return True
             return func
         elif name in ('append_multi', 'prepend_multi', 'delete_multi'):
             def func2(keys, *args, **kwargs):
                 for k in keys:
-                    self.dataset.pop(k, None)
+                    self._pop(k)
                 return True
             return func2
         raise AttributeError(name)
@@ -1,18 +1,91 @@
+import os
 import re
+import json
+import time
+import math
+import random
+import string
 import inspect
+import threading
 from functools import wraps
-from pickle import UnpicklingError
 
-from sqlalchemy.ext.serializer import loads, dumps  # 处理sqlalchemy的model实例
-
-from corelib.utils import Empty, empty
+from corelib.codec import encode, decode, SchemaChanged
+from corelib.utils import Empty, generate_id
+from corelib.consts import ONE_MINUTE, ONE_HOUR, ONE_DAY
+from corelib.local_cache import LocalCache
 from . import rdb
 
 
 __formaters = {}
 percent_pattern = re.compile(r'%\w')
 brace_pattern = re.compile(r'\{[\w\d\.\[\]_]+\}')
-BUILTIN_TYPES = (int, bytes, str, float, bool)
+
+# 删除缓存时广播被删除的keys，各进程据此清理自己的L1缓存
+L1_INVALIDATE_CHANNEL = 'mc:l1:invalidate'
+
+__l1_caches = {}  # key family -> LocalCache
+__l1_lock = threading.Lock()
+__l1_listener_pid = None
+
+# 防缓存击穿(single-flight): 只有拿到锁的请求重新计算，其他请求读旧值或等待
+LOCK_KEY = '{}:lock'
+STALE_KEY = '{}:stale'  # 旧值副本，`delete_mc`不会删除它
+DELTA_KEY = '{}:delta'  # 上次重新计算的耗时(ms)，用于提前刷新
+LOCK_TIMEOUT = 10
+WAIT_TIMEOUT = 3
+WAIT_INTERVAL = 0.05
+STALE_EXPIRE = ONE_HOUR
+
+# 分页列表等一组缓存共用一个版本号，失效时只需`INCR`版本号，旧版本的数据靠过期清理
+NAMESPACE_KEY = 'mc:ns:{}'
+VERSIONED_KEY = '{}@v{}'
+NAMESPACE_EXPIRE = ONE_DAY  # 带版本号的缓存没有指定`expire`时的过期时间
+# 版本号本身的过期时间，要比带版本号的缓存活得久，每次递增时重新计算；
+# 过期后重新用当前毫秒时间初始化，只是让旧版本的缓存提前失效
+NAMESPACE_KEY_EXPIRE = NAMESPACE_EXPIRE * 2
+
+# hash，field为`key family:event`，如`core:PostTag:get_post_ids_by_tag:suppressed`，
+# value为所有进程累计的次数，由`manage.py cache_stats`查看
+STATS_KEY = 'mc:stats'
+
+_release_lock = rdb.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+
+# 计数缓存不存在时不创建，下次读取时再完整计算
+_incr_if_exists = rdb.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('incrby', KEYS[1], ARGV[1])
+end
+return false
+""")
+
+
+# 计数hash不存在时不创建，下次读取时再完整加载
+_hincr_if_exists = rdb.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('hincrby', KEYS[1], ARGV[1], ARGV[2])
+end
+return false
+""")
+
+# 集合不存在时不创建，下次读取时从数据库完整加载；传入`KEYS[2]`时把操作记在
+# 这个hash里(member -> 操作)，由加载集合的脚本补上加载期间提交的修改
+_update_set_if_exists = rdb.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call(ARGV[1], KEYS[1], ARGV[2])
+end
+if KEYS[2] then
+    redis.call('hset', KEYS[2], ARGV[2], ARGV[1])
+    redis.call('expire', KEYS[2], ARGV[3])
+end
+return false
+""")
+SET_PENDING_EXPIRE = ONE_MINUTE  # 要比从数据库加载一个集合的时间长
 
 
 def formater(text):
@@ -53,6 +126,12 @@ def format(text, *a, **kw):
     return f(*a, **kw)
 
 
+def getargspec(f):
+    """ `inspect.getargspec`在新版本Python中已被移除 """
+    spec = inspect.getfullargspec(f)
+    return spec.args, spec.varargs, spec.varkw, spec.defaults
+
+
 def gen_key(key_pattern, arg_names, defaults, *a, **kw):
     return gen_key_factory(key_pattern, arg_names, defaults)(*a, **kw)
 
@@ -60,7 +139,7 @@ def gen_key(key_pattern, arg_names, defaults, *a, **kw):
 def gen_key_factory(key_pattern, arg_names, defaults):
     args = dict(zip(arg_names[-len(defaults):], defaults)) if defaults else {}
     if callable(key_pattern):
-        names = inspect.getargspec(key_pattern)[0]
+        names = getargspec(key_pattern)[0]
 
     def gen_key(*a, **kw):
         aa = args.copy()
@@ -74,46 +153,510 @@ def gen_key_factory(key_pattern, arg_names, defaults):
     return gen_key
 
 
-def cache(key_pattern, expire=None):
+def compile_key_pattern(key_pattern, arg_names):
+    """
+    在装饰时把`key_pattern`编译成按位置取参数的函数`build(values)`，
+    `values`按`arg_names`排列，生成的key和`gen_key_factory`完全一致。
+    无法编译时返回`None`
+    """
+    if callable(key_pattern):
+        try:
+            idx = [arg_names.index(n) for n in getargspec(key_pattern)[0]]
+        except ValueError:
+            return None
+        return lambda v: key_pattern(*[v[i] for i in idx])
+
+    percent = percent_pattern.findall(key_pattern)
+    if percent and brace_pattern.search(key_pattern):
+        raise Exception('mixed format is not allowed')
+    if percent:
+        n = len(percent)
+        return lambda v: key_pattern % tuple(v[:n])
+    elif '%(' in key_pattern:
+        return lambda v: key_pattern % dict(zip(arg_names, v))
+
+    # 把`{cls.__name__}`这类命名字段改写成`{0.__name__}`
+    parts = []
+    for literal, field, spec, conv in string.Formatter().parse(key_pattern):
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+        root, sep, rest = field.partition('.')
+        if '[' in root:
+            root, bracket, tail = root.partition('[')
+            rest, sep = bracket + tail + sep + rest, ''
+        if not root.isdigit():
+            if root not in arg_names:
+                return None
+            root = str(arg_names.index(root))
+        parts.append('{%s%s%s%s%s}' % (root, sep, rest,
+                                       '!' + conv if conv else '',
+                                       ':' + spec if spec else ''))
+    fmt = ''.join(parts).format
+    return lambda v: fmt(*v)
+
+
+def key_builder(key_pattern, arg_names, defaults):
+    """ 返回`build(*a, **kw) -> key`，参数齐全且只用位置参数时不会创建中间字典 """
+    compiled = compile_key_pattern(key_pattern, arg_names)
+    if compiled is None:
+        gen = gen_key_factory(key_pattern, arg_names, defaults)
+        return lambda *a, **kw: gen(*a, **kw)[0]
+
+    n = len(arg_names)
+    defaults = defaults or ()
+    first_default = n - len(defaults)
+
+    def build(*a, **kw):
+        if kw or len(a) != n:
+            values = list(a)
+            for i in range(len(a), n):
+                name = arg_names[i]
+                if name in kw:
+                    values.append(kw[name])
+                elif i >= first_default:
+                    values.append(defaults[i - first_default])
+                else:
+                    raise TypeError('missing argument %r' % name)
+            a = values
+        key = compiled(a)
+        return key and key.replace(' ', '_')
+    return build
+
+
+def register_l1(family, l1):
+    """ 注册进程内的L1缓存，收到失效广播时会从中清理对应的keys """
+    return __l1_caches.setdefault(family, l1)
+
+
+def key_family(key_pattern):
+    """ 如`db:BaseModel:get(%s,%s)`的family是`db:BaseModel:get` """
+    return key_pattern.split('(')[0] if isinstance(key_pattern, str) \
+        else key_pattern.__qualname__
+
+
+def l1_family(key_pattern, max_bytes):
+    """ 同一个key family共用一个L1缓存 """
+    return register_l1(key_family(key_pattern), LocalCache(max_bytes))
+
+
+def _on_l1_invalidate(message):
+    keys = json.loads(message['data'])
+    for l1 in __l1_caches.values():
+        l1.delete_multi(keys)
+
+
+def ensure_l1_listener():
+    """ 每个进程(包括fork出的worker)各自订阅一次失效广播 """
+    global __l1_listener_pid
+    pid = os.getpid()
+    if __l1_listener_pid == pid:
+        return
+    with __l1_lock:
+        if __l1_listener_pid == pid:
+            return
+        for l1 in __l1_caches.values():
+            l1.clear()  # fork前的L1数据没有被订阅保护，直接丢弃
+        pubsub = rdb.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{L1_INVALIDATE_CHANNEL: _on_l1_invalidate})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+        __l1_listener_pid = pid
+
+
+def evict_l1(*keys, pipe=None):
+    """ 清理本进程的L1缓存，并通知其他进程清理 """
+    if not keys:
+        return
+    for l1 in __l1_caches.values():
+        l1.delete_multi(keys)
+    (pipe or rdb).publish(L1_INVALIDATE_CHANNEL, json.dumps(keys))
+
+
+def delete_mc(*keys):
+    """ 所有缓存的删除都要经过这里，Redis和各进程的L1缓存一起失效 """
+    if not keys:
+        return
+    pipe = rdb.pipeline(transaction=False)
+    pipe.delete(*keys)
+    evict_l1(*keys, pipe=pipe)
+    pipe.execute()
+
+
+def namespace_version(ns):
+    """
+    版本号不存在(从未使用或被Redis淘汰)时用当前毫秒时间初始化，
+    不会和淘汰前的版本号重复，旧版本的缓存也就不会被读到
+    """
+    return namespace_versions([ns])[0]
+
+
+def namespace_versions(namespaces):
+    """ `namespace_version`的批量版本，一次pipeline读取 """
+    now = int(time.time() * 1000)
+    pipe = rdb.pipeline(transaction=False)
+    for ns in namespaces:
+        key = NAMESPACE_KEY.format(ns)
+        pipe.set(key, now, ex=NAMESPACE_KEY_EXPIRE, nx=True)
+        pipe.get(key)
+    return [int(v) for v in pipe.execute()[1::2]]
+
+
+def bump_namespace(*namespaces, pipe=None):
+    """ 让`namespaces`下的所有缓存失效，每个namespace只需一次`INCR` """
+    if not namespaces:
+        return
+    p = pipe or rdb.pipeline(transaction=False)
+    now = int(time.time() * 1000)
+    for ns in namespaces:
+        key = NAMESPACE_KEY.format(ns)
+        p.set(key, now, nx=True)
+        p.incr(key)
+        p.expire(key, NAMESPACE_KEY_EXPIRE)
+    if pipe is None:
+        p.execute()
+
+
+class InvalidationBuffer(object):
+    """
+    收集一个事务里的缓存失效操作(删除key、增减计数、更新namespace版本号、
+    累加待持久化的计数增量、增删集合和有序集合成员)，事务提交后由`flush`用一次pipeline发送，
+    事务回滚时`discard`全部丢弃
+    """
+    def __init__(self):
+        self.keys = {}  # 当作有序集合使用
+        self.incrs = {}  # key -> amount
+        self.hincrs = {}  # (key, field, create) -> amount
+        # (key, member) -> ('sadd' | 'srem', pending key)，以最后一次为准
+        self.members = {}
+        self.zsets = {}  # (key, member) -> score，`None`表示删除
+        self.namespaces = {}
+
+    def __bool__(self):
+        return bool(self.keys or self.incrs or self.hincrs or self.members or
+                    self.zsets or self.namespaces)
+
+    def delete(self, *keys):
+        self.keys.update(dict.fromkeys(keys))
+
+    def incr(self, key, amount):
+        self.incrs[key] = self.incrs.get(key, 0) + amount
+
+    def hincr(self, key, field, amount, create=True):
+        """ `create`为False时只更新已经存在的hash，用于缓存的计数 """
+        k = (key, field, create)
+        self.hincrs[k] = self.hincrs.get(k, 0) + amount
+
+    def sadd(self, key, member, pending=None):
+        """ 集合不存在时，传入了`pending`就把操作记在这个hash里 """
+        self.members[key, member] = ('sadd', pending)
+
+    def srem(self, key, member, pending=None):
+        self.members[key, member] = ('srem', pending)
+
+    def zadd(self, key, member, score):
+        self.zsets[key, member] = score
+
+    def zrem(self, key, member):
+        self.zsets[key, member] = None
+
+    def bump(self, *namespaces):
+        self.namespaces.update(dict.fromkeys(namespaces))
+
+    def discard(self):
+        self.keys, self.incrs, self.hincrs = {}, {}, {}
+        self.members, self.zsets, self.namespaces = {}, {}, {}
+
+    def flush(self):
+        """
+        返回删除了的keys，计数缓存里不是整数的也会被删除，
+        不存在的计数缓存和集合不会被创建
+        """
+        keys = list(self.keys)
+        incrs = [(k, n) for k, n in self.incrs.items() if n]
+        hincrs = [(k, f, c, n) for (k, f, c), n in self.hincrs.items() if n]
+        members = list(self.members.items())
+        zsets = list(self.zsets.items())
+        namespaces = list(self.namespaces)
+        self.discard()
+        if not (keys or incrs or hincrs or members or zsets or namespaces):
+            return []
+
+        pipe = rdb.pipeline(transaction=False)
+        if keys:
+            pipe.delete(*keys)
+            evict_l1(*keys, pipe=pipe)
+        for key, amount in incrs:
+            _incr_if_exists(keys=[key], args=[amount], client=pipe)
+        for key, field, create, amount in hincrs:
+            if create:
+                pipe.hincrby(key, field, amount)
+            else:
+                _hincr_if_exists(keys=[key], args=[field, amount],
+                                 client=pipe)
+        for (key, member), (op, pending) in members:
+            _update_set_if_exists(keys=[key] + ([pending] if pending else []),
+                                  args=[op, member, SET_PENDING_EXPIRE],
+                                  client=pipe)
+        for (key, member), score in zsets:
+            if score is None:
+                pipe.zrem(key, member)
+            else:
+                pipe.zadd(key, {member: score})
+        bump_namespace(*namespaces, pipe=pipe)
+        rs = pipe.execute(raise_on_error=False)
+
+        offset = 2 if keys else 0
+        counters = [key for key, _ in incrs] + [
+            key if not create else None for key, _, create, _ in hincrs]
+        broken = list(dict.fromkeys(
+            key for key, r in zip(counters, rs[offset:])
+            if key and isinstance(r, Exception)))
+        if broken:
+            delete_mc(*broken)
+        return keys + broken
+
+
+def incr_stats(family, event):
+    rdb.hincrby(STATS_KEY, '{}:{}'.format(family, event))
+
+
+def get_stats():
+    """ {`key family:event`: 次数} """
+    return {k.decode(): int(v) for k, v in rdb.hgetall(STATS_KEY).items()}
+
+
+def _recompute(key, compute, expire, family, single_flight=False,
+               early_refresh=0, stale_key=None):
+    """
+    重新计算并写入缓存，返回序列化后的值。
+    `stale_key`是旧值副本的key，带版本号的缓存传入不带版本号的key，
+    版本号递增后等待的请求仍能读到上一个版本的值
+    """
+    if not single_flight:
+        return _store(key, compute, expire, early_refresh)
+
+    lock_key = LOCK_KEY.format(key)
+    token = generate_id()
+    stale_key = STALE_KEY.format(stale_key or key)
+    if rdb.set(lock_key, token, ex=LOCK_TIMEOUT, nx=True):
+        incr_stats(family, 'recompute')
+        try:
+            return _store(key, compute, expire, early_refresh,
+                          stale_key=stale_key)
+        finally:
+            _release_lock(keys=[lock_key], args=[token])
+
+    incr_stats(family, 'suppressed')
+    r = rdb.get(stale_key)
+    if r is not None:
+        incr_stats(family, 'stale')
+        return r
+
+    deadline = time.time() + WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        r = rdb.get(key)
+        if r is not None:
+            return r
+    incr_stats(family, 'wait_timeout')
+    return _dumps(compute())  # 等不到就自己算，但不写缓存，避免覆盖持锁者的结果
+
+
+def _store(key, compute, expire, early_refresh=0, stale_key=None):
+    start = time.time()
+    r = _dumps(compute())
+    pipe = rdb.pipeline(transaction=False)
+    pipe.set(key, r, expire)
+    if stale_key:
+        pipe.set(stale_key, r, STALE_EXPIRE)
+    if early_refresh and expire:
+        delta = max(int((time.time() - start) * 1000), 1)
+        pipe.set(DELTA_KEY.format(key), delta, expire)
+    pipe.execute()
+    return r
+
+
+def _should_refresh_early(ttl, delta, beta):
+    """
+    XFetch: 剩余时间`ttl`越短、重新计算越慢(`delta`)，越可能提前刷新，
+    这样过期前总有一个请求先把缓存刷新好，不会在过期瞬间一起未命中
+    """
+    if ttl is None or ttl < 0 or delta is None:
+        return False
+    return -int(delta) * beta * math.log(random.random()) >= ttl
+
+
+_dumps = encode
+
+
+def _loads(r):
+    """ 缓存的数据已不可用时抛出`SchemaChanged` """
+    r = decode(r)
+    if isinstance(r, Empty):
+        r = None
+    return r
+
+
+def cache(key_pattern, expire=None, l1_size=0, l1_ttl=None,
+          single_flight=False, early_refresh=0, namespace=None):
+    """
+    `l1_size`(bytes)大于0时启用进程内的L1缓存，L1里存的是序列化后的数据，
+    每次命中都会反序列化出新的对象，避免多个请求共享同一个model实例。
+    L1由`delete_mc`的广播保持一致，`l1_ttl`是订阅断开时的兜底。
+
+    `single_flight`: 缓存失效时只让一个请求重新计算，其他请求返回旧值或等待；
+    `early_refresh`: XFetch的beta值(一般取1.0)，只对设置了`expire`的缓存有效。
+    重新计算和被抑制的次数记录在`STATS_KEY`里。
+
+    `namespace`: 和`key_pattern`同样格式的namespace，它的版本号会拼到key里，
+    用`bump_namespace`一次让整组缓存(如某篇文章评论的所有分页)失效。
+    """
     def deco(f):
-        arg_names, varargs, varkw, defaults = inspect.getargspec(f)
+        arg_names, varargs, varkw, defaults = getargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
-        gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        build_key = key_builder(key_pattern, arg_names, defaults)
+        build_ns = namespace and key_builder(namespace, arg_names, defaults)
+        l1 = l1_family(key_pattern, l1_size) if l1_size else None
+        family = key_family(key_pattern)
+        timeout = expire or (NAMESPACE_EXPIRE if namespace else None)
+        if namespace and timeout > NAMESPACE_KEY_EXPIRE:
+            raise Exception("expire must be shorter than the namespace's")
+        xfetch = early_refresh and timeout
 
         @wraps(f)
         def _(*a, **kw):
-            key, args = gen_key(*a, **kw)
+            key = base_key = build_key(*a, **kw)
             if not key:
                 return f(*a, **kw)
+            if build_ns:
+                version = namespace_version(build_ns(*a, **kw))
+                key = VERSIONED_KEY.format(key, version)
             force = kw.pop('force', False)
-            r = rdb.get(key) if not force else None
+            r = None
+            if l1 is not None and not force:
+                ensure_l1_listener()
+                r = l1.get(key)
+                if r is not None:
+                    return _loads(r)
 
+            if force:
+                r = None
+            elif xfetch:
+                pipe = rdb.pipeline(transaction=False)
+                pipe.get(key)
+                pipe.pttl(key)
+                pipe.get(DELTA_KEY.format(key))
+                r, ttl, delta = pipe.execute()
+                if r is not None and _should_refresh_early(
+                        ttl, delta, early_refresh):
+                    incr_stats(family, 'early_refresh')
+                    r = None
+            else:
+                r = rdb.get(key)
+            if r is not None:
+                try:
+                    value = _loads(r)
+                except SchemaChanged:
+                    r = None
             if r is None:
-                r = f(*a, **kw)
+                r = _recompute(key, lambda: f(*a, **kw), timeout, family,
+                               single_flight, early_refresh, base_key)
+                value = _loads(r)
+            if l1 is not None:
+                l1.set(key, r, l1_ttl)
+            return value
+        _.original_function = f
+        return _
+    return deco
+
+
+def cache_multi(key_pattern, expire=None, l1_size=0, l1_ttl=None,
+                normalize=None):
+    """
+    `cache`的批量版本，被装饰函数的最后一个参数是`ids`列表，
+    `key_pattern`里用`{id}`表示`ids`中的单个元素，因此可以和`cache`共用缓存。
+
+    先用一次`MGET`读取全部缓存，未命中的`ids`一次性交给被装饰函数，
+    它要返回`{id: value}`字典，再用一次pipeline写回缓存。
+    结果按`ids`的顺序返回，不存在的对象为`None`。
+    `normalize`把调用方传入的id转换成被装饰函数返回的字典的key(如`int`)，
+    转换失败的id直接返回`None`，不读写缓存
+    """
+    def deco(f):
+        arg_names, varargs, varkw, defaults = getargspec(f)
+        if varargs or varkw:
+            raise Exception("do not support varargs")
+        build_key = key_builder(key_pattern, arg_names[:-1] + ['id'], None)
+        l1 = l1_family(key_pattern, l1_size) if l1_size else None
+
+        @wraps(f)
+        def _(*a, **kw):
+            force = kw.pop('force', False)
+            a = a + tuple(kw[n] for n in arg_names[len(a):])
+            head, ids = a[:-1], list(a[-1])
+            if not ids:
+                return []
+            if normalize is not None:
+                ids = _normalize_ids(ids, normalize)
+            # 转换失败的id不读写缓存，也不交给被装饰函数
+            pos = [i for i, id in enumerate(ids) if id is not None]
+            values = [None] * len(ids)
+            ids = [ids[i] for i in pos]
+            if not ids:
+                return values
+
+            keys = [build_key(*head, id) for id in ids]
+            rs = [None] * len(keys)
+            if l1 is not None and not force:
+                ensure_l1_listener()
+                rs = l1.get_list(keys)
+            idx = [i for i, r in enumerate(rs) if r is None]
+            if idx and not force:
+                for i, r in zip(idx, rdb.mget([keys[i] for i in idx])):
+                    rs[i] = r
+                    if r is not None and l1 is not None:
+                        l1.set(keys[i], r, l1_ttl)
+
+            for i, r in enumerate(rs):
                 if r is not None:
-                    if not isinstance(r, BUILTIN_TYPES):
-                        r = dumps(r)
-                    rdb.set(key, r, expire)
-                else:
-                    r = dumps(empty)
-                    rdb.set(key, r, expire)
-
-            try:
-                r = loads(r)
-            except (TypeError, UnpicklingError):
-                pass
-            if isinstance(r, Empty):
-                r = None
-            return r
+                    try:
+                        values[pos[i]] = _loads(r)
+                    except SchemaChanged:
+                        rs[i] = None
+
+            missing = list(dict.fromkeys(
+                id for id, r in zip(ids, rs) if r is None))
+            if missing:
+                found = f(*head, missing) or {}
+                pipe = rdb.pipeline(transaction=False)
+                for i, (id, key) in enumerate(zip(ids, keys)):
+                    if rs[i] is None:
+                        rs[i] = _dumps(found.get(id))
+                        values[pos[i]] = _loads(rs[i])
+                        pipe.set(key, rs[i], expire)
+                        if l1 is not None:
+                            l1.set(key, rs[i], l1_ttl)
+                pipe.execute()
+            return values
         _.original_function = f
         return _
     return deco
 
 
+def _normalize_ids(ids, normalize):
+    values = []
+    for id in ids:
+        try:
+            values.append(normalize(id))
+        except (TypeError, ValueError):
+            values.append(None)
+    return values
+
+
 def pcache(key_pattern, count=300, expire=None):
     def deco(f):
-        arg_names, varargs, varkw, defaults = inspect.getargspec(f)
+        arg_names, varargs, varkw, defaults = getargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
         if not ('limit' in arg_names):
@@ -133,11 +676,14 @@ def pcache(key_pattern, count=300, expire=None):
             force = kw.pop('force', False)
             r = rdb.get(key) if not force else None
 
+            if r is not None:
+                try:
+                    r = _loads(r)
+                except SchemaChanged:
+                    r = None
             if r is None:
                 r = f(limit=count, **args)
-                r = dumps(r)
-                rdb.set(key, r, expire)
-            r = loads(r)
+                rdb.set(key, _dumps(r), expire)
             return r[start:start + limit]
         _.original_function = f
         return _
@@ -146,7 +692,7 @@ def pcache(key_pattern, count=300, expire=None):
 
 def pcache2(key_pattern, count=300, expire=None):
     def deco(f):
-        arg_names, varargs, varkw, defaults = inspect.getargspec(f)
+        arg_names, varargs, varkw, defaults = getargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
         if not ('limit' in arg_names):
@@ -164,13 +710,14 @@ def pcache2(key_pattern, count=300, expire=None):
             n = 0
             force = kw.pop('force', False)
             d = rdb.get(key) if not force else None
+            if d is not None:
+                try:
+                    n, r = _loads(d)
+                except SchemaChanged:
+                    d = None
             if d is None:
                 n, r = f(limit=count, **args)
-                r = dumps(n, r)
-                rdb.set(key, (n, r), expire)
-            else:
-                n, r = loads(d)
-                r = loads(r)
+                rdb.set(key, _dumps([n, r]), expire)
             return (n, r[start:start + limit])
         _.original_function = f
         return _
@@ -1,10 +1,13 @@
 import os
+import json
 import time
+import base64
 import struct
 import random
 import binascii
 import threading
 import urllib.parse
+from datetime import datetime
 
 _missing = object()
 
@@ -124,6 +127,57 @@ def update_url_query(url, params):
     return urllib.parse.urlunparse(url_parts)
 
 
+def encode_cursor(values):
+    """ 把上一页最后一行的排序值编码成不透明的游标，`datetime`精确到微秒 """
+    values = [{'dt': v.isoformat()} if isinstance(v, datetime) else v
+              for v in values]
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ 空游标返回`None`(第一页)，无法解析时抛出`ValueError` """
+    if not cursor:
+        return None
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+        if not isinstance(values, list):
+            raise ValueError(cursor)
+        return [datetime.fromisoformat(v['dt']) if isinstance(v, dict)
+                else v for v in values]
+    except (TypeError, KeyError, binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(cursor) from e
+
+
+class CursorPage:
+    """
+    游标分页的结果，`next_cursor`为`None`表示没有下一页。
+    `total`来自维护好的计数器，不做`COUNT(*)`
+    """
+    def __init__(self, items, per_page, next_cursor=None, cursor=None,
+                 total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.cursor = cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<CursorPage items: {0} next: {1}>'.format(
+            len(self.items), self.next_cursor)
+
+
 def incr_key(stat_key, amount):
     from corelib.db import rdb
     from redis.exceptions import ResponseError
@@ -5,14 +5,18 @@ from celery.utils.log import get_task_logger
 from app import app as _app
 from handler.celery import app
 from corelib.consts import K_POST
+from corelib.mc import delete_mc as _delete_mc
 from models.search import Item, TARGET_MAPPER
 from models.core import Post
+from models.counter import flush_deltas as _flush_deltas
 from models.feed import (
     feed_followed_posts_to_follower as _feed_followed_posts_to_follower,
     feed_post_to_followers as _feed_post_to_followers,
+    feed_post_to_follower_chunk as _feed_post_to_follower_chunk,
     remove_post_from_feed as _remove_post_from_feed,
     add_to_activity_feed as _add_to_activity_feed,
-    remove_user_posts_from_feed as _remove_user_posts_from_feed)
+    remove_user_posts_from_feed as _remove_user_posts_from_feed,
+    rebuild_feed as _rebuild_feed)
 
 logger = get_task_logger(__name__)
 
@@ -33,6 +37,12 @@ def send_email(smtp_host, from_addr, login_pwd, to_addrs, msg):
     s.quit()
 
 
+@app.task
+def delete_mc(keys):
+    """ 事务提交后延迟再删一次缓存 """
+    _delete_mc(*keys)
+
+
 @app.task(base=RequestContextTask)
 def reindex(id, kind, op_type):
     target_cls = TARGET_MAPPER.get(kind)
@@ -81,6 +91,13 @@ def feed_post_to_followers(id):
     logger.info(f'feed_post_to_followers {id}')
 
 
+@app.task(base=RequestContextTask)
+def feed_post_to_follower_chunk(post_id, author_id, score, from_ids):
+    _feed_post_to_follower_chunk(post_id, author_id, score, from_ids)
+    logger.info(f'feed_post_to_follower_chunk {post_id}, '
+                f'followers:{len(from_ids)}')
+
+
 @app.task(base=RequestContextTask)
 def remove_post_from_feed(post_id, author_id):
     _remove_post_from_feed(post_id, author_id)
@@ -98,3 +115,16 @@ def remove_user_posts_from_feed(visit_id, uid):
 def add_to_activity_feed(post_id):
     _add_to_activity_feed(post_id)
     logger.info(f'Add_to_activity_feed post_id:{post_id}')
+
+
+@app.task(base=RequestContextTask)
+def rebuild_feed(from_id):
+    n = _rebuild_feed(from_id)
+    logger.info(f'Rebuild_feed from_id:{from_id}, posts:{n}')
+
+
+@app.task(base=RequestContextTask)
+def flush_action_counters():
+    n = _flush_deltas()
+    if n:
+        logger.info(f'Flush_action_counters rows:{n}')
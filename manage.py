@@ -60,6 +60,113 @@ def reset_environ():
     # os.system('celery worker -A handler.celery -l info')
 
 
+@app.cli.command('migrate_props',
+                 short_help='Moves JSON props blobs into Redis hashes.')
+@click.option('--batch', default=500, help='每批迁移的对象数量')
+@with_appcontext
+def migrate_props(batch):
+    from models.core import Post
+    from models.comment import CommentItem
+    from corelib.db import PROPS_MIGRATED_KEY
+
+    for cls in (Post, CommentItem):
+        total, last_id = 0, 0
+        while True:
+            ids = [id for id, in cls.query.with_entities(cls.id).filter(
+                cls.id > last_id).order_by(cls.id).limit(batch)]
+            if not ids:
+                break
+            total += cls.migrate_props(ids)
+            last_id = ids[-1]
+        print(f'{cls.__name__}: {total} migrated')
+    rdb.set(PROPS_MIGRATED_KEY, 1)  # 之后写入props不再检查旧数据
+
+
+@app.cli.command('reindex', short_help='Rebuilds Elasticsearch items of posts.')
+@click.option('--batch', default=500, help='每批重建的文章数量')
+@with_appcontext
+def reindex(batch):
+    from models.core import Post
+
+    total, last_id = 0, 0
+    while True:
+        posts = Post.query.filter(Post.id > last_id).order_by(
+            Post.id).limit(batch).all()
+        if not posts:
+            break
+        Post.prefetch_tags(posts)  # 每批只查询一次tags和props
+        Post.prefetch_props(posts)
+        for post in posts:
+            Item.update_item(post)
+        total += len(posts)
+        last_id = posts[-1].id
+    print(f'{total} posts reindexed')
+
+
+@app.cli.command('reconcile_counters',
+                 short_help='Recomputes drifted action counters.')
+@click.option('--batch', default=1000, help='每块统计的对象数量')
+@with_appcontext
+def reconcile_counters(batch):
+    from models.like import LikeItem
+    from models.collect import CollectItem
+    from models.comment import CommentItem
+
+    for cls in (LikeItem, CollectItem, CommentItem):
+        fixed = cls.reconcile_counters(batch)
+        if fixed is None:
+            print(f'{cls.__name__}: counter flush lock is busy, skipped')
+        else:
+            print(f'{cls.__name__}: {fixed} fixed')
+
+
+@app.cli.command('import_follows',
+                 short_help='Imports follows from a CSV file.')
+@click.argument('csv_file', type=click.File())
+@click.option('--batch', default=1000, help='每批导入的关注关系数量')
+@with_appcontext
+def import_follows(csv_file, batch):
+    import csv
+    from models.contact import Contact
+
+    pairs = [(int(from_id), int(to_id))
+             for from_id, to_id in csv.reader(csv_file)]
+    print(f'{Contact.bulk_create(pairs, batch)} follows imported')
+
+
+@app.cli.command('backfill_follow_graph',
+                 short_help='Writes all follows into the Redis follow graph.')
+@click.option('--batch', default=1000, help='每个pipeline写入的关注关系数量')
+@with_appcontext
+def backfill_follow_graph(batch):
+    from models.contact import Contact
+
+    print(f'{Contact.backfill_graph(batch)} follows written')
+
+
+@app.cli.command('backfill_feed_ready',
+                 short_help='Marks feeds that existed before deploy as ready.')
+@click.option('--batch', default=1000, help='每次扫描和写入的feed流数量')
+@with_appcontext
+def backfill_feed_ready(batch):
+    from models.feed import backfill_feed_ready
+
+    print(f'{backfill_feed_ready(batch)} feeds marked ready')
+
+
+@app.cli.command('cache_stats',
+                 short_help='Shows single-flight and early refresh counts.')
+@click.option('--reset', is_flag=True, help='显示后清零')
+@with_appcontext
+def cache_stats(reset):
+    from corelib.mc import STATS_KEY, get_stats
+
+    for name, n in sorted(get_stats().items()):
+        print(f'{name}: {n}')
+    if reset:
+        rdb.delete(STATS_KEY)
+
+
 @app.cli.command('ishell', short_help='Runs a IPython shell in the app context.')
 @click.argument('ipython_args', nargs=-1, type=click.UNPROCESSED)
 @with_appcontext
@@ -1,10 +1,12 @@
-import math
+from sqlalchemy import func, and_
 
 from config import PER_PAGE
-from corelib.mc import cache
-from corelib.db import rdb
-from corelib.utils import incr_key
-from corelib.consts import K_POST
+from corelib.mc import cache, cache_multi, delete_mc
+from corelib.db import db, rdb, mc_buffer, keyset_paginate
+from corelib.consts import K_POST, ONE_DAY, ONE_MINUTE
+from models.counter import (ActionCounter, COUNTER_DELTA_KEY, delta_field,
+                            get_counts, set_counts, get_pending_deltas,
+                            flush_lock, flush_deltas)
 
 # action_type, target_id, target_kind 统计对象被 <like|collect|comment> 的数量
 MC_KEY_GET_COUNT_BY_TARGET = 'actionmixin:ActionMixin:get_count_by_target(%s,%s,%s)'  # noqa
@@ -15,38 +17,134 @@ MC_KEY_GET_COUNT_BY_USER = 'actionmixin:ActionMixin:get_count_by_user(%s,%s,%s)'
 # action_type, target_id, target_kind, page 特指post的comment列表分页
 MC_KEY_GET_PAGE_BY_TARGET = 'actionmixin:ActionMixin:get_page_by_target(%s,%s,%s,%s)'  # noqa
 
-# action_type, user_id, target_id, target_kind 判断用户是否 <like|collect|comment> 对象
-MC_KEY_GET_BY_TARGET = 'actionmixin:ActionMixin:get_by_target(%s,%s,%s,%s)'  # noqa
+# action_type, target_id, target_kind <like|collect> 对象的用户id集合，带`MEMBERS_LOADED`时才是完整的 # noqa
+MC_KEY_MEMBERS = 'actionmixin:ActionMixin:members(%s,%s,%s)'
+MEMBERS_LOADED = 0  # 哨兵成员，用户id从1开始
+MEMBERS_EXPIRE = ONE_DAY
+
+# action_type, target_id, target_kind 集合不存在时提交的 <like|collect>，
+# hash，field为user_id，value为`sadd`或`srem`，加载集合时补上
+MC_KEY_MEMBERS_PENDING = 'actionmixin:ActionMixin:members_pending(%s,%s,%s)'
+
+# 集合已经存在时不写入，避免覆盖加载期间并发的`SADD/SREM`；
+# 创建集合后补上`KEYS[2]`里加载期间提交的修改，重复执行也没有影响
+_load_set_if_absent = rdb.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+local unpack = table.unpack or unpack
+for i = 2, #ARGV, 1000 do
+    redis.call('sadd', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+local ops = redis.call('hgetall', KEYS[2])
+for i = 1, #ops, 2 do
+    redis.call(ops[i + 1], KEYS[1], ops[i])
+end
+redis.call('del', KEYS[2])
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+""")
 
 # acton_type, user_id, target_kind, page 用户 <like|collect> 的post列表分页
 MC_KEY_GET_PAGINATE_BY_USER = 'actionmixin:ActionMixin:get_paginate_by_user(%s,%s,%s,%s)'  # noqa
 
+# action_type, target_id, target_kind 对象的 <comment> 列表游标分页的第一页，之后的页不缓存 # noqa
+MC_KEY_GET_CURSOR_PAGE_BY_TARGET = 'actionmixin:ActionMixin:get_cursor_page_by_target(%s,%s,%s)'  # noqa
+
+# action_type, user_id, target_kind 用户 <like|collect> 的post列表游标分页的第一页 # noqa
+MC_KEY_GET_CURSOR_PAGE_BY_USER = 'actionmixin:ActionMixin:get_cursor_page_by_user(%s,%s,%s)'  # noqa
+
+# action_type, target_id, target_kind 对象的 <comment> 列表所有分页的版本号
+MC_NS_PAGE_BY_TARGET = 'actionmixin:ActionMixin:page_by_target(%s,%s,%s)'
+
+# action_type, user_id, target_kind 用户 <like|collect> 列表所有分页的版本号
+MC_NS_PAGINATE_BY_USER = 'actionmixin:ActionMixin:paginate_by_user(%s,%s,%s)'
+
 
 class ActionMixin:
     """ ActionMixin for `CollectItem`, `CommentItem`, `LikeItem` """
     action_type = None
+    track_members = False  # 是否维护`MC_KEY_MEMBERS`集合，一个用户可以多次评论
 
     @classmethod
     @cache(MC_KEY_GET_COUNT_BY_TARGET %
-           ('{cls.action_type}', '{target_id}', '{target_kind}'))
+           ('{cls.action_type}', '{target_id}', '{target_kind}'),
+           expire=ONE_DAY)
     def get_count_by_target(cls, target_id, target_kind):
-        """ 统计对象被 <like|collect|comment> 的数量，
-        只有第一次是从数据库读取，以后都是在缓存里的增减数值，好处是减少数据库的读取操作 """
-        return cls.query.filter_by(target_id=target_id,
-                                   target_kind=target_kind).count()
+        """ 统计对象被 <like|collect|comment> 的数量，之后由`clear_mc`增减缓存，
+        缓存失效时读取`action_counters`并加上还没写入的增量，不扫描动作表 """
+        return get_counts(cls.action_type, target_kind, [target_id])[target_id]
+
+    @classmethod
+    @cache_multi(MC_KEY_GET_COUNT_BY_TARGET %
+                 ('{cls.action_type}', '{id}', '{target_kind}'),
+                 expire=ONE_DAY, normalize=int)
+    def get_count_by_targets(cls, target_kind, target_ids):
+        """ `get_count_by_target`的批量版本，未命中的用一次`IN`查询读取 """
+        return get_counts(cls.action_type, target_kind, target_ids)
 
     @classmethod
-    @cache(MC_KEY_GET_BY_TARGET %
-           ('{cls.action_type}', '{user_id}', '{target_id}', '{target_kind}'))
     def get_by_target(cls, user_id, target_id, target_kind):
-        """ 判断用户是否 <like|collect|comment> 对象 """
+        """ 取消 <like|collect> 时读取要删除的记录，判断是否存在用`has_member` """
         return cls.query.filter_by(user_id=user_id,
                                    target_id=target_id,
                                    target_kind=target_kind).first()
 
+    @classmethod
+    def _load_members(cls, target_kind, target_ids):
+        """
+        用一次`IN`查询(`idx_ti_tk_ui`覆盖)加载完整的集合，只在集合不存在时
+        原子地写入Redis，并补上查询之后提交、记在`MC_KEY_MEMBERS_PENDING`的修改
+        """
+        members = {id: [MEMBERS_LOADED] for id in target_ids}
+        for target_id, user_id in cls.query.with_entities(
+                cls.target_id, cls.user_id).filter(
+                    cls.target_kind == target_kind,
+                    cls.target_id.in_(target_ids)):
+            members[target_id].append(user_id)
+        pipe = rdb.pipeline(transaction=False)
+        for id, user_ids in members.items():
+            ident = (cls.action_type, id, target_kind)
+            _load_set_if_absent(keys=[MC_KEY_MEMBERS % ident,
+                                      MC_KEY_MEMBERS_PENDING % ident],
+                                args=[MEMBERS_EXPIRE, *user_ids], client=pipe)
+        pipe.execute()
+        return members
+
+    @classmethod
+    def has_members(cls, user_id, target_kind, target_ids):
+        """ 用户是否 <like|collect> 每个对象，一次pipeline里每个对象两次`SISMEMBER`，
+        集合不存在的对象从数据库加载 """
+        if not user_id:
+            return [False] * len(target_ids)
+        pipe = rdb.pipeline(transaction=False)
+        for id in target_ids:
+            key = MC_KEY_MEMBERS % (cls.action_type, id, target_kind)
+            pipe.sismember(key, user_id)
+            pipe.sismember(key, MEMBERS_LOADED)
+        rs = pipe.execute()
+        flags, missing = {}, []
+        for id, is_member, loaded in zip(target_ids, rs[::2], rs[1::2]):
+            if loaded:
+                flags[id] = bool(is_member)
+            else:
+                missing.append(id)
+        if missing:
+            for id, user_ids in cls._load_members(target_kind,
+                                                  missing).items():
+                flags[id] = user_id in user_ids
+        return [flags[id] for id in target_ids]
+
+    @classmethod
+    def has_member(cls, user_id, target_id, target_kind):
+        """ 判断用户是否 <like|collect> 对象 """
+        return cls.has_members(user_id, target_kind, [target_id])[0]
+
     @classmethod
     @cache(MC_KEY_GET_PAGINATE_BY_USER %
-           ('{cls.action_type}', '{user_id}', '{target_kind}', '{page}'))
+           ('{cls.action_type}', '{user_id}', '{target_kind}', '{page}'),
+           namespace=MC_NS_PAGINATE_BY_USER %
+           ('{cls.action_type}', '{user_id}', '{target_kind}'))
     def get_paginate_by_user(cls, user_id, target_kind=K_POST, page=1):
         """ 用户 <like|collect> 的post列表分页 """
         query = cls.query.with_entities(cls.target_id).filter_by(
@@ -66,9 +164,10 @@ class ActionMixin:
 
     @classmethod
     @cache(MC_KEY_GET_PAGE_BY_TARGET %
-           ('{cls.action_type}', '{target_id}', '{target_kind}', '{page}'))
-    def get_page_by_target(cls, target_id, target_kind, page=1):
-        """ 特指post的comment列表分页 """
+           ('{cls.action_type}', '{target_id}', '{target_kind}', '{page}'),
+           namespace=MC_NS_PAGE_BY_TARGET %
+           ('{cls.action_type}', '{target_id}', '{target_kind}'))
+    def _get_page_by_target(cls, target_id, target_kind, page=1):
         query = cls.query.filter_by(target_id=target_id,
                                     target_kind=target_kind).order_by(
                                         cls.id.desc())
@@ -78,6 +177,132 @@ class ActionMixin:
             items = query.limit(PER_PAGE).offset(PER_PAGE * (page - 1)).all()
         return items
 
+    @classmethod
+    def get_page_by_target(cls, target_id, target_kind, page=1):
+        """ 特指post的comment列表分页，评论内容一次批量读取 """
+        items = cls._get_page_by_target(target_id, target_kind, page)
+        cls.prefetch_props(items)
+        return items
+
+    @classmethod
+    @cache(MC_KEY_GET_CURSOR_PAGE_BY_TARGET %
+           ('{cls.action_type}', '{target_id}', '{target_kind}'),
+           namespace=MC_NS_PAGE_BY_TARGET %
+           ('{cls.action_type}', '{target_id}', '{target_kind}'))
+    def _get_first_cursor_page_by_target(cls, target_id, target_kind):
+        return cls._get_cursor_page_by_target(target_id, target_kind)
+
+    @classmethod
+    def _get_cursor_page_by_target(cls, target_id, target_kind, cursor=None):
+        query = cls.query.with_entities(cls.id).filter_by(
+            target_id=target_id, target_kind=target_kind)
+        page = keyset_paginate(query, [cls.id], cursor)
+        page.items = [id for id, in page.items]
+        return page
+
+    @classmethod
+    def get_cursor_page_by_target(cls, target_id, target_kind, cursor=None):
+        """ 按id倒序的游标分页，翻到多深都不会变慢，`total`取自计数缓存 """
+        # 客户端传来的游标不进入缓存key，只缓存第一页
+        if cursor:
+            page = cls._get_cursor_page_by_target(target_id, target_kind,
+                                                  cursor)
+        else:
+            page = cls._get_first_cursor_page_by_target(target_id,
+                                                        target_kind)
+        page.items = cls.get_multi(page.items)
+        cls.prefetch_props(page.items)
+        page.total = int(cls.get_count_by_target(target_id, target_kind))
+        return page
+
+    @classmethod
+    @cache(MC_KEY_GET_CURSOR_PAGE_BY_USER %
+           ('{cls.action_type}', '{user_id}', '{target_kind}'),
+           namespace=MC_NS_PAGINATE_BY_USER %
+           ('{cls.action_type}', '{user_id}', '{target_kind}'))
+    def _get_first_cursor_page_by_user(cls, user_id, target_kind=K_POST):
+        return cls._get_cursor_page_by_user(user_id, target_kind)
+
+    @classmethod
+    def _get_cursor_page_by_user(cls, user_id, target_kind=K_POST,
+                                 cursor=None):
+        query = cls.query.with_entities(cls.id, cls.target_id).filter_by(
+            user_id=user_id, target_kind=target_kind)
+        page = keyset_paginate(query, [cls.id], cursor)
+        page.items = [target_id for _, target_id in page.items]
+        return page
+
+    @classmethod
+    def get_cursor_page_by_user(cls, user_id, target_kind=K_POST,
+                                cursor=None):
+        """ 用户 <like|collect> 的post id游标分页 """
+        if cursor:
+            page = cls._get_cursor_page_by_user(user_id, target_kind, cursor)
+        else:
+            page = cls._get_first_cursor_page_by_user(user_id, target_kind)
+        page.total = int(cls.get_count_by_user(user_id, target_kind))
+        return page
+
+    @classmethod
+    def reconcile_counters(cls, batch=1000, wait=ONE_MINUTE):
+        """
+        持有写入锁，先写入全部增量，再按`target_id`分块重新统计，把和
+        `action_counters`不一致的计数改成准确值并删除计数缓存，返回修正的
+        数量，`wait`秒内拿不到锁返回`None`。还没写入的增量之后会累加上去，
+        所以存的是准确值减去增量；统计前后增量有变化的对象这次跳过
+        """
+        action_type = cls.action_type
+        c = ActionCounter
+        with flush_lock(wait) as extend:
+            if extend is None:
+                return None
+            flush_deltas(lock=False)
+            fixed, last_id = 0, 0
+            while True:
+                extend()
+                db.session.commit()  # 结束事务，之后的统计读到最新提交
+                ids = [id for id, in cls.query.with_entities(
+                    cls.target_id).filter(cls.target_id > last_id).group_by(
+                        cls.target_id).order_by(cls.target_id).limit(batch)]
+                # 最后一块不设上限
+                upper = ids[-1] if len(ids) == batch else None
+
+                def in_chunk(column):
+                    if upper is None:
+                        return column > last_id
+                    return and_(column > last_id, column <= upper)
+
+                before = get_pending_deltas(action_type)
+                actual = {(id, kind): n for id, kind, n in
+                          cls.query.with_entities(
+                              cls.target_id, cls.target_kind,
+                              func.count(cls.id)).filter(
+                                  in_chunk(cls.target_id)).group_by(
+                                      cls.target_id, cls.target_kind)}
+                stored = {(id, kind): n for id, kind, n in
+                          c.query.with_entities(
+                              c.target_id, c.target_kind, c.n).filter(
+                                  c.action_type == action_type,
+                                  in_chunk(c.target_id))}
+                pending = get_pending_deltas(action_type)
+                drifted = {}
+                for key in actual.keys() | stored.keys():
+                    delta = pending.get(key, 0)
+                    if delta != before.get(key, 0):
+                        continue
+                    n = actual.get(key, 0) - delta
+                    if n != stored.get(key):
+                        drifted[key] = n
+                if drifted:
+                    set_counts(action_type, drifted)
+                    delete_mc(*(MC_KEY_GET_COUNT_BY_TARGET %
+                                (action_type, id, kind)
+                                for id, kind in drifted))
+                    fixed += len(drifted)
+                if upper is None:
+                    return fixed
+                last_id = upper
+
     @classmethod
     def __flush_insert_event__(cls, target):
         super().__flush_insert_event__(target)
@@ -95,27 +320,23 @@ class ActionMixin:
 
         target_id = target.target_id
         target_kind = target.target_kind
-        stat_key = MC_KEY_GET_COUNT_BY_TARGET % (action_type, target_id,
-                                                 target_kind)
-        total = incr_key(stat_key, amount)
-        pages = math.ceil(max(total, 1) / PER_PAGE)
-
         user_id = target.user_id
-        rdb.delete(MC_KEY_GET_BY_TARGET %
-                   (action_type, user_id, target_id,
-                    target_kind))
-        for p in list(range(1, pages + 1)) + [None]:
-            rdb.delete(
-                MC_KEY_GET_PAGE_BY_TARGET %
-                (action_type, target_id, target_kind, p))
+        buf = mc_buffer(target)
+        buf.incr(MC_KEY_GET_COUNT_BY_TARGET %
+                 (action_type, target_id, target_kind), amount)
+        buf.hincr(COUNTER_DELTA_KEY,
+                  delta_field(action_type, target_id, target_kind), amount)
+        if cls.track_members:
+            ident = (action_type, target_id, target_kind)
+            key = MC_KEY_MEMBERS % ident
+            pending = MC_KEY_MEMBERS_PENDING % ident
+            if amount > 0:
+                buf.sadd(key, user_id, pending)
+            else:
+                buf.srem(key, user_id, pending)
+        buf.bump(MC_NS_PAGE_BY_TARGET % (action_type, target_id, target_kind))
 
         # mc by user
-        stat_key = MC_KEY_GET_COUNT_BY_USER % (
-            action_type, user_id, target_kind)
-        total = incr_key(stat_key, amount)
-        pages = math.ceil(max(total, 1) / PER_PAGE)
-
-        for p in range(1, pages + 1):
-            rdb.delete(
-                MC_KEY_GET_PAGINATE_BY_USER %
-                (action_type, user_id, target_kind, p))
+        buf.incr(MC_KEY_GET_COUNT_BY_USER %
+                 (action_type, user_id, target_kind), amount)
+        buf.bump(MC_NS_PAGINATE_BY_USER % (action_type, user_id, target_kind))
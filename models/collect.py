@@ -10,6 +10,7 @@ class CollectItem(ActionMixin, db.Model):
 
     # 根据action_type判断相似功能的类, 如CommentItem, LikeItem
     action_type = 'collect'
+    track_members = True
 
     __table_args__ = (db.Index('idx_ti_tk_ui', target_id, target_kind,
                                user_id), )
@@ -17,8 +18,7 @@ class CollectItem(ActionMixin, db.Model):
 
 class CollectMixin:
     def collect(self, user_id):
-        item = CollectItem.get_by_target(user_id, self.id, self.kind)
-        if item:
+        if CollectItem.has_member(user_id, self.id, self.kind):
             return False
         ok, _ = CollectItem.create(user_id=user_id,
                                    target_id=self.id,
@@ -37,4 +37,4 @@ class CollectMixin:
         return int(CollectItem.get_count_by_target(self.id, self.kind))
 
     def is_collected_by(self, user_id):
-        return bool(CollectItem.get_by_target(user_id, self.id, self.kind))
+        return CollectItem.has_member(user_id, self.id, self.kind)
@@ -3,12 +3,13 @@ from corelib.db import db
 from models.actionmixin import ActionMixin
 from models.like import LikeMixin
 from models.user import User
-from corelib.db import PropsItem
+from corelib.db import PropsItem, HashPropsMixin, MC_NS_FRAGMENT
+from corelib.mc import bump_namespace
 from corelib.consts import K_COMMENT
 from corelib.utils import cached_property
 
 
-class CommentItem(ActionMixin, LikeMixin, db.Model):
+class CommentItem(ActionMixin, LikeMixin, HashPropsMixin, db.Model):
     __tablename__ = 'comment_items'
     user_id = db.Column(db.Integer)
     target_id = db.Column(db.Integer)
@@ -37,8 +38,9 @@ class CommentMixin(object):
                                      target_id=self.id,
                                      target_kind=self.kind,
                                      ref_id=ref_id)
-        if ok:
+        if ok:  # `content`在提交之后才写入，再让评论片段失效一次
             obj.content = content
+            bump_namespace(MC_NS_FRAGMENT % (CommentItem.__name__, obj.id))
         return ok, obj
 
     def del_comment(self, user_id, comment_id):
@@ -4,14 +4,25 @@
 |————————————————————————————————————————————————————————|
 |  count  |    0...n             1              0...n    |
 |————————————————————————————————————————————————————————|
+
+关注关系图
+1. 每个用户在Redis里有关注者`FOLLOWERS_KEY`和正在关注`FOLLOWING_KEY`两个有序集合，
+   分数是关注时间，和`contacts`表在同一个事务提交后更新；
+2. `backfill_follow_graph`命令流式读取全部关注关系写入后设置`GRAPH_READY_KEY`，
+   没有这个标记时分发、关注判断和列表分页都读取数据库
 """
 
-import math
+from collections import Counter
+from datetime import datetime
+
+from flask_sqlalchemy import Pagination
+from sqlalchemy.exc import IntegrityError
 
-from corelib.db import db
+from corelib.db import (db, rdb, keyset_paginate, mc_buffer, bulk_incr,
+                         MC_KEY_GET_ID)
 from config import PER_PAGE
-from corelib.mc import cache
-from corelib.db import rdb
+from corelib.consts import ONE_DAY
+from corelib.mc import cache, cache_multi
 from models.exceptions import NotAllowedException
 
 # from_id, page 正在关注的列表分页
@@ -20,9 +31,36 @@ MC_KEY_GET_FOLLOWING_PAGINATE = 'contact:Contact:get_following_paginate(%s,%s)'
 # to_id, page 关注者列表分页
 MC_KEY_GET_FOLLOWERS_PAGINATE = 'contact:Contact:get_followers_paginate(%s,%s)'
 
+# from_id 正在关注的列表游标分页的第一页，之后的页不缓存
+MC_KEY_GET_FOLLOWING_CURSOR_PAGE = 'contact:Contact:get_following_cursor_page(%s)'  # noqa
+
+# to_id 关注者列表游标分页的第一页，之后的页不缓存
+MC_KEY_GET_FOLLOWERS_CURSOR_PAGE = 'contact:Contact:get_followers_cursor_page(%s)'  # noqa
+
+# from_id 正在关注列表所有分页的版本号
+MC_NS_FOLLOWING = 'contact:Contact:following(%s)'
+
+# to_id 关注者列表所有分页的版本号
+MC_NS_FOLLOWERS = 'contact:Contact:followers(%s)'
+
 # from_id, to_id  # 两用户是否关注
 MC_KEY_GET_FOLLOW_ITEM = 'contact:Contact:get_follow_item(%s,%s)'
 
+# user_id 关注者数和正在关注数的hash，由`userFollowStats.incr_counts`增减
+MC_KEY_FOLLOW_STATS = 'contact:userFollowStats:counts(%s)'
+FOLLOW_STATS_FIELDS = ('follower_count', 'following_count')
+FOLLOW_STATS_EXPIRE = ONE_DAY
+
+# to_id 关注者的有序集合，member为from_id，score为关注时间
+FOLLOWERS_KEY = 'contact:followers:{}'
+
+# from_id 正在关注的有序集合，member为to_id，score为关注时间
+FOLLOWING_KEY = 'contact:following:{}'
+
+# 关注关系已经全部回填到Redis的标记
+GRAPH_READY_KEY = 'contact:graph_ready'
+GRAPH_BATCH = 1000
+
 
 class Contact(db.Model):
     """ 关注关系 """
@@ -41,23 +79,170 @@ class Contact(db.Model):
 
     @classmethod
     def create(cls, **kwargs):
-        ok, obj = super().create(**kwargs)
-        cls.clear_mc(obj, 1)
-        if ok:
-            from handler.tasks import feed_followed_posts_to_follower
-            feed_followed_posts_to_follower.delay(obj.from_id, obj.to_id)
-        return ok, obj
+        """ 关注关系和双方的计数在同一个事务里写入 """
+        obj = cls.query.filter_by(**kwargs).first()
+        if obj:
+            return False, obj
+        obj = cls(**kwargs)
+        db.session.add(obj)
+        try:
+            db.session.flush()  # 并发的重复关注在这里因`uk_from_to`失败，不会多计数
+        except IntegrityError:
+            db.session.rollback()
+            return False, cls.query.filter_by(**kwargs).first()
+        cls.clear_mc([(obj.from_id, obj.to_id)], 1,
+                     obj.created_at.timestamp())
+        db.session.commit()
+        from handler.tasks import feed_followed_posts_to_follower
+        feed_followed_posts_to_follower.delay(obj.from_id, obj.to_id)
+        return True, obj
+
+    @classmethod
+    def bulk_create(cls, pairs, batch=1000):
+        """
+        批量导入关注关系`pairs`: [(from_id, to_id)]，已存在的跳过，返回新建的数量。
+        每批一次查询、一次批量插入和两条计数upsert，不回填关注者的feed
+        """
+        pairs = list(dict.fromkeys(pairs))
+        total = 0
+        for i in range(0, len(pairs), batch):
+            chunk = pairs[i:i + batch]
+            existed = set(cls.query.with_entities(
+                cls.from_id, cls.to_id).filter(
+                    cls.from_id.in_({from_id for from_id, _ in chunk}),
+                    cls.to_id.in_({to_id for _, to_id in chunk})))
+            new = [pair for pair in chunk if pair not in existed]
+            if not new:
+                continue
+            now = datetime.utcnow()
+            db.session.bulk_insert_mappings(cls, [
+                dict(from_id=from_id, to_id=to_id, created_at=now)
+                for from_id, to_id in new])
+            cls.clear_mc(new, 1, now.timestamp())
+            db.session.commit()
+            total += len(new)
+        return total
 
     def delete(self):
-        super().delete()
-        self.clear_mc(self, -1)
-        from handler.tasks import remove_user_posts_from_feed
-        remove_user_posts_from_feed.delay(self.from_id, self.to_id)
+        """ 并发取消关注时只有真正删除了记录的一次更新计数 """
+        from_id, to_id = self.from_id, self.to_id
+        table = self.__table__
+        r = db.session.execute(table.delete().where(table.c.id == self.id))
+        if r.rowcount:
+            self.__flush_event__(self)
+            self.clear_mc([(from_id, to_id)], -1)
+        db.session.commit()
+        if r.rowcount:
+            from handler.tasks import remove_user_posts_from_feed
+            remove_user_posts_from_feed.delay(from_id, to_id)
+
+    @classmethod
+    def backfill_graph(cls, batch=GRAPH_BATCH):
+        """
+        流式读取全部关注关系写入`FOLLOWERS_KEY`/`FOLLOWING_KEY`，每`batch`条一次pipeline，
+        完成后设置`GRAPH_READY_KEY`，返回写入的关注关系数量
+        """
+        rdb.delete(GRAPH_READY_KEY)
+        rows = db.session.query(cls.from_id, cls.to_id, cls.created_at).\
+            execution_options(stream_results=True).yield_per(batch)
+        pipe = rdb.pipeline(transaction=False)
+        n = 0
+        for n, (from_id, to_id, created_at) in enumerate(rows, 1):
+            score = created_at.timestamp()
+            pipe.zadd(FOLLOWERS_KEY.format(to_id), {from_id: score})
+            pipe.zadd(FOLLOWING_KEY.format(from_id), {to_id: score})
+            if n % batch == 0:
+                pipe.execute()
+        pipe.execute()
+        rdb.set(GRAPH_READY_KEY, 1)
+        return n
+
+    @staticmethod
+    def graph_ready():
+        return bool(rdb.exists(GRAPH_READY_KEY))
+
+    @classmethod
+    def iter_follower_ids(cls, to_id, batch=GRAPH_BATCH):
+        """ 按批返回关注者id，关系图不可用时按`idx_to_time_from`索引用游标查询 """
+        if cls.graph_ready():
+            key = FOLLOWERS_KEY.format(to_id)
+            start = 0
+            while True:
+                ids = rdb.zrange(key, start, start + batch - 1)
+                if ids:
+                    yield [int(id) for id in ids]
+                if len(ids) < batch:
+                    return
+                start += batch
+
+        query = cls.query.with_entities(cls.created_at, cls.from_id).filter(
+            cls.to_id == to_id)
+        cursor = None
+        while True:
+            page = keyset_paginate(query, [cls.created_at, cls.from_id],
+                                   cursor, per_page=batch)
+            if page.items:
+                yield [from_id for _, from_id in page.items]
+            cursor = page.next_cursor
+            if not cursor:
+                return
+
+    @classmethod
+    def get_following_ids(cls, from_id):
+        if cls.graph_ready():
+            return [int(id) for id in rdb.zrange(
+                FOLLOWING_KEY.format(from_id), 0, -1)]
+        return [id for id, in cls.query.with_entities(cls.to_id).filter(
+            cls.from_id == from_id)]
+
+    @classmethod
+    def is_following(cls, from_id, to_ids):
+        """ `from_id`是否关注了`to_ids`中的每个用户，关系图可用时一次pipeline读取 """
+        if not to_ids:
+            return []
+        key = FOLLOWING_KEY.format(from_id)
+        pipe = rdb.pipeline(transaction=False)
+        pipe.exists(GRAPH_READY_KEY)
+        for to_id in to_ids:
+            pipe.zscore(key, to_id)
+        ready, *scores = pipe.execute()
+        if ready:
+            return [score is not None for score in scores]
+        return [bool(item) for item in cls.get_follow_items(from_id, to_ids)]
+
+    @staticmethod
+    def _get_graph_page(key, page):
+        """ 按关注时间倒序读取关系图的一页，关系图不可用时返回`None` """
+        start = (page - 1) * PER_PAGE
+        pipe = rdb.pipeline(transaction=False)
+        pipe.exists(GRAPH_READY_KEY)
+        pipe.zrevrange(key, start, start + PER_PAGE - 1)
+        pipe.zcard(key)
+        ready, ids, total = pipe.execute()
+        if not ready:
+            return None
+        return Pagination(None, page, PER_PAGE, total, [int(id) for id in ids])
 
     @classmethod
-    @cache(MC_KEY_GET_FOLLOWERS_PAGINATE % ('{to_id}', '{page}'))
     def get_followers_paginate(cls, to_id, page=1):
         """ 获取`followers`列表分页 """
+        followers = cls._get_graph_page(FOLLOWERS_KEY.format(to_id), page)
+        if followers is None:
+            followers = cls._get_followers_paginate(to_id, page)
+        return followers
+
+    @classmethod
+    def get_following_paginate(cls, from_id, page=1):
+        """ 获取`following`正在关注列表分页 """
+        following = cls._get_graph_page(FOLLOWING_KEY.format(from_id), page)
+        if following is None:
+            following = cls._get_following_paginate(from_id, page)
+        return following
+
+    @classmethod
+    @cache(MC_KEY_GET_FOLLOWERS_PAGINATE % ('{to_id}', '{page}'),
+           namespace=MC_NS_FOLLOWERS % '{to_id}')
+    def _get_followers_paginate(cls, to_id, page=1):
         query = cls.query.with_entities(cls.from_id).filter_by(
             to_id=to_id)
         followers = query.paginate(page, PER_PAGE)
@@ -66,9 +251,9 @@ class Contact(db.Model):
         return followers
 
     @classmethod
-    @cache(MC_KEY_GET_FOLLOWING_PAGINATE % ('{from_id}', '{page}'))
-    def get_following_paginate(cls, from_id, page=1):
-        """ 获取`following`正在关注列表分页 """
+    @cache(MC_KEY_GET_FOLLOWING_PAGINATE % ('{from_id}', '{page}'),
+           namespace=MC_NS_FOLLOWING % '{from_id}')
+    def _get_following_paginate(cls, from_id, page=1):
         query = cls.query.with_entities(cls.to_id).filter_by(
             from_id=from_id)
         following = query.paginate(page, PER_PAGE)
@@ -76,6 +261,51 @@ class Contact(db.Model):
         del following.query
         return following
 
+    @classmethod
+    @cache(MC_KEY_GET_FOLLOWERS_CURSOR_PAGE % '{to_id}',
+           namespace=MC_NS_FOLLOWERS % '{to_id}')
+    def _get_first_followers_cursor_page(cls, to_id):
+        return cls._get_followers_cursor_page(to_id)
+
+    @classmethod
+    def _get_followers_cursor_page(cls, to_id, cursor=None):
+        query = cls.query.with_entities(cls.created_at, cls.from_id).filter_by(
+            to_id=to_id)  # 索引`idx_to_time_from`
+        page = keyset_paginate(query, [cls.created_at, cls.from_id], cursor)
+        page.items = [from_id for _, from_id in page.items]
+        return page
+
+    @classmethod
+    def get_followers_cursor_page(cls, to_id, cursor=None):
+        """ `followers`列表游标分页，按关注时间倒序 """
+        # 客户端传来的游标不进入缓存key，只缓存第一页
+        page = cls._get_followers_cursor_page(to_id, cursor) if cursor else \
+            cls._get_first_followers_cursor_page(to_id)
+        page.total = userFollowStats.get_counts([to_id])[0][0]
+        return page
+
+    @classmethod
+    @cache(MC_KEY_GET_FOLLOWING_CURSOR_PAGE % '{from_id}',
+           namespace=MC_NS_FOLLOWING % '{from_id}')
+    def _get_first_following_cursor_page(cls, from_id):
+        return cls._get_following_cursor_page(from_id)
+
+    @classmethod
+    def _get_following_cursor_page(cls, from_id, cursor=None):
+        query = cls.query.with_entities(cls.to_id).filter_by(
+            from_id=from_id)  # 索引`uk_from_to`
+        page = keyset_paginate(query, [cls.to_id], cursor)
+        page.items = [to_id for to_id, in page.items]
+        return page
+
+    @classmethod
+    def get_following_cursor_page(cls, from_id, cursor=None):
+        """ `following`列表游标分页，按用户id倒序 """
+        page = cls._get_following_cursor_page(from_id, cursor) if cursor \
+            else cls._get_first_following_cursor_page(from_id)
+        page.total = userFollowStats.get_counts([from_id])[0][1]
+        return page
+
     @classmethod
     @cache(MC_KEY_GET_FOLLOW_ITEM % ('{from_id}', '{to_id}'))
     def get_follow_item(cls, from_id, to_id):
@@ -83,29 +313,35 @@ class Contact(db.Model):
         return cls.query.filter_by(from_id=from_id, to_id=to_id).first()
 
     @classmethod
-    def clear_mc(cls, target, amount):
-        """ 关注和取消都要清理缓存及更新相关对象 """
-        to_id = target.to_id
-        from_id = target.from_id
+    @cache_multi(MC_KEY_GET_FOLLOW_ITEM % ('{from_id}', '{id}'),
+                 normalize=int)
+    def get_follow_items(cls, from_id, to_ids):
+        """ `get_follow_item`的批量版本，`from_id`是否关注了`to_ids`中的用户 """
+        return {item.to_id: item for item in cls.query.filter(
+            cls.from_id == from_id, cls.to_id.in_(to_ids))}
 
-        st = userFollowStats.get_or_create(to_id)
-        follower_count = st.follower_count or 0
-        st.follower_count = follower_count + amount
-        st.save()  # 注意，放在sqlalchemy的清理钩子里，会报错
-
-        st = userFollowStats.get_or_create(from_id)
-        following_count = st.following_count or 0
-        st.following_count = following_count + amount
-        st.save()
-
-        rdb.delete(MC_KEY_GET_FOLLOW_ITEM % (from_id, to_id))
-
-        for user_id, total, mc_key in (
-                (to_id, follower_count, MC_KEY_GET_FOLLOWERS_PAGINATE),
-                (from_id, following_count, MC_KEY_GET_FOLLOWING_PAGINATE)):
-            pages = math.ceil((max(total, 0) or 1) / PER_PAGE)
-            for p in range(1, pages + 1):
-                rdb.delete(mc_key % (user_id, p))
+    @classmethod
+    def clear_mc(cls, pairs, amount, score=None):
+        """
+        关注和取消都要在当前事务里更新双方的计数，提交后清理缓存并更新关系图，
+        关注时`score`是关注时间
+        """
+        followers, following = Counter(), Counter()
+        buf = mc_buffer()
+        for from_id, to_id in pairs:
+            followers[to_id] += amount
+            following[from_id] += amount
+            buf.delete(MC_KEY_GET_FOLLOW_ITEM % (from_id, to_id))
+            buf.bump(MC_NS_FOLLOWERS % to_id, MC_NS_FOLLOWING % from_id)
+            followers_key = FOLLOWERS_KEY.format(to_id)
+            following_key = FOLLOWING_KEY.format(from_id)
+            if amount > 0:
+                buf.zadd(followers_key, from_id, score)
+                buf.zadd(following_key, to_id, score)
+            else:
+                buf.zrem(followers_key, from_id)
+                buf.zrem(following_key, to_id)
+        userFollowStats.incr_counts(followers, following)
 
 
 class userFollowStats(db.Model):
@@ -114,9 +350,43 @@ class userFollowStats(db.Model):
     following_count = db.Column(db.Integer, default=0)
 
     @classmethod
-    def get_or_create(cls, id, **kw):
-        st = cls.get(id)
-        if not st:
-            st = cls(id=id)
-            st.save()
-        return st
+    def incr_counts(cls, followers, following):
+        """
+        `followers`/`following`: {user_id: 增量}，在当前事务里用
+        `count = count + n`原子累加，不会丢失并发关注的计数，提交后再增减Redis里的计数
+        """
+        buf = mc_buffer()
+        for field, counts in zip(FOLLOW_STATS_FIELDS, (followers, following)):
+            rows = [{'id': id, field: n}
+                    for id, n in sorted(counts.items()) if n]
+            bulk_incr(cls, ('id', ), field, rows)
+            for row in rows:
+                id = row['id']
+                buf.hincr(MC_KEY_FOLLOW_STATS % id, field, row[field],
+                          create=False)
+                buf.delete(MC_KEY_GET_ID % (cls.__name__, id))
+
+    @classmethod
+    def get_counts(cls, ids):
+        """ 用户的(关注者数, 正在关注数)，读取Redis hash，未命中的用一次`IN`查询加载 """
+        pipe = rdb.pipeline(transaction=False)
+        for id in ids:
+            pipe.hmget(MC_KEY_FOLLOW_STATS % id, FOLLOW_STATS_FIELDS)
+        counts, missing = {}, []
+        for id, values in zip(ids, pipe.execute()):
+            if None in values:
+                missing.append(id)
+            else:
+                counts[id] = tuple(int(v) for v in values)
+        if missing:
+            stats = {st.id: st for st in cls.query.filter(cls.id.in_(missing))}
+            for id in missing:
+                st = stats.get(id)
+                counts[id] = (st and st.follower_count or 0,
+                              st and st.following_count or 0)
+                key = MC_KEY_FOLLOW_STATS % id
+                pipe.hset(key, mapping=dict(zip(FOLLOW_STATS_FIELDS,
+                                                counts[id])))
+                pipe.expire(key, FOLLOW_STATS_EXPIRE)
+            pipe.execute()
+        return [counts[id] for id in ids]
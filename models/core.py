@@ -1,11 +1,14 @@
-import math
 from urllib.request import urlparse
 
+from flask_sqlalchemy import Pagination
+from sqlalchemy import func
+
 from config import PER_PAGE
-from corelib.consts import K_POST
-from corelib.mc import cache
-from corelib.db import PropsItem, rdb, db
-from corelib.utils import (cached_property, is_numeric, trunc_utf8, incr_key)
+from corelib.consts import K_POST, ONE_HOUR
+from corelib.mc import cache, cache_multi, delete_mc, bump_namespace
+from corelib.db import (PropsItem, HashPropsMixin, db, mc_buffer,
+                         keyset_paginate, MC_NS_FRAGMENT)
+from corelib.utils import cached_property, is_numeric, trunc_utf8
 from models.user import User
 from models.like import LikeMixin
 from models.comment import CommentMixin
@@ -21,14 +24,20 @@ MC_KEY_TAGS = 'core:Post:tags(%s)'
 # tag.name 通过name获取tag对象
 MC_KEY_GET_BY_NAME = 'core:Tag:get_by_name(%s)'
 
-# tag.id|tag.name， page 通过id或name获取post分页
-MC_KEY_GET_POSTS_BY_TAG = 'core:PostTag:get_posts_by_tag(%s,%s)'
+# tag.id|tag.name， page 通过id或name获取post id分页
+MC_KEY_GET_POST_IDS_BY_TAG = 'core:PostTag:get_post_ids_by_tag(%s,%s)'
+
+# tag.id|tag.name 通过id或name获取post id游标分页的第一页，之后的页不缓存
+MC_KEY_GET_POST_IDS_BY_TAG_CURSOR = 'core:PostTag:get_post_ids_by_tag_cursor(%s)'  # noqa
 
 # tag.id|tag.name 通过id或name获取post的数量 # noqa
 MC_KEY_GET_COUNT_BY_TAG = 'core:PostTag:get_post_count_by_tag(%s)'
 
+# identifier 标签下post列表所有分页的版本号
+MC_NS_POST_IDS_BY_TAG = 'core:PostTag:post_ids_by_tag(%s)'
 
-class Post(CommentMixin, LikeMixin, CollectMixin, db.Model):
+
+class Post(CommentMixin, LikeMixin, CollectMixin, HashPropsMixin, db.Model):
     __tablename__ = 'posts'
     author_id = db.Column(db.Integer)
     title = db.Column(db.String(128), default='')
@@ -57,12 +66,27 @@ class Post(CommentMixin, LikeMixin, CollectMixin, db.Model):
     @property
     @cache(MC_KEY_TAGS % ('{self.id}'))
     def tags(self):
-        tag_ids = PostTag.query.with_entities(PostTag.tag_id).\
-            filter(PostTag.post_id == self.id).all()
+        return Tag.query.join(PostTag, PostTag.tag_id == Tag.id).filter(
+            PostTag.post_id == self.id).order_by(PostTag.id).all()
 
-        tags = Tag.query.filter(Tag.id.in_((id for id, in tag_ids))).all()
+    @classmethod
+    @cache_multi(MC_KEY_TAGS % ('{id}'), normalize=int)
+    def get_tags_multi(cls, ids):
+        """ 和`tags`共用缓存，未命中的文章用一次JOIN查询加载 """
+        tags = {id: [] for id in ids}
+        rows = db.session.query(PostTag.post_id, Tag).join(
+            Tag, Tag.id == PostTag.tag_id).filter(
+                PostTag.post_id.in_(ids)).order_by(PostTag.id)
+        for post_id, tag in rows:
+            tags[post_id].append(tag)
         return tags
 
+    @classmethod
+    def prefetch_tags(cls, posts):
+        """ 一页文章或一批重建索引的文章先调用它，之后读取`post.tags`都命中缓存 """
+        ids = list(dict.fromkeys(p.id for p in posts if p is not None))
+        return dict(zip(ids, cls.get_tags_multi(ids))) if ids else {}
+
     @cached_property
     def abstract_content(self):
         return trunc_utf8(self.content, 100)
@@ -82,10 +106,12 @@ class Post(CommentMixin, LikeMixin, CollectMixin, db.Model):
         if created:
             from handler.tasks import feed_post_to_followers
             feed_post_to_followers.delay(obj.id)
+        else:  # `content`在提交之后才写入，再让卡片片段失效一次
+            bump_namespace(MC_NS_FRAGMENT % (cls.__name__, obj.id))
         return created, obj
 
     def update(self, **kwargs):
-        rdb.delete(MC_KEY_GET_BY_TITLE % self.title)  # 注意，在更新前清除缓存
+        delete_mc(MC_KEY_GET_BY_TITLE % self.title)  # 注意，在更新前清除缓存
         super().update(**kwargs)
 
     def delete(self):
@@ -102,14 +128,19 @@ class Post(CommentMixin, LikeMixin, CollectMixin, db.Model):
 
     @classmethod
     def clear_mc(cls, target):
-        rdb.delete(MC_KEY_GET_BY_TITLE % target.title)
-        rdb.delete(MC_KEY_TAGS % target.id)
+        mc_buffer(target).delete(MC_KEY_GET_BY_TITLE % target.title,
+                                 MC_KEY_TAGS % target.id)
 
     @classmethod
     def __flush_delete_event__(cls, target):
         super().__flush_delete_event__(target)
         cls.clear_mc(target)
 
+    @classmethod
+    def __flush_after_update_event__(cls, target):
+        super().__flush_after_update_event__(target)
+        mc_buffer(target).bump(MC_NS_FRAGMENT % (cls.__name__, target.id))
+
 
 class Tag(db.Model):
     """ 原则上Tag一旦创建，则不能修改或删除 """
@@ -119,10 +150,27 @@ class Tag(db.Model):
     __table_args__ = (db.Index('idx_name', name), )
 
     @classmethod
-    @cache(MC_KEY_GET_BY_NAME % ('{name}'))
+    @cache(MC_KEY_GET_BY_NAME % ('{name}'),
+           l1_size=1024 * 1024, l1_ttl=ONE_HOUR)
     def get_by_name(cls, name):
         return cls.query.filter_by(name=name).first()
 
+    @classmethod
+    def get_id(cls, identifier):
+        """ `identifier`: tag_id or tag_name """
+        if not identifier:
+            return None
+        if is_numeric(identifier):
+            return int(identifier)
+        tag = cls.get_by_name(identifier)
+        return tag.id if tag else None
+
+    @classmethod
+    def __flush_insert_event__(cls, target):
+        super().__flush_insert_event__(target)
+        # 清理创建前缓存的`None`
+        mc_buffer(target).delete(MC_KEY_GET_BY_NAME % target.name)
+
     def delete(self):
         raise NotAllowedException
 
@@ -144,41 +192,76 @@ class PostTag(db.Model):
     __table_args__ = (
         db.Index('idx_post_id', post_id, 'updated_at'),
         db.Index('idx_tag_id', tag_id, 'updated_at'),
+        db.Index('idx_tag_post', tag_id, post_id),  # 标签下的文章列表只扫描索引
     )
 
     @classmethod
-    def _get_posts_by_tag(cls, identifier):
-        if not identifier:
-            return
-        if not is_numeric(identifier):
-            tag = Tag.get_by_name(identifier)
-            if not tag:
-                return
-            identifier = tag.id
-        post_ids = cls.query.with_entities(
-            cls.post_id).filter(cls.tag_id == identifier).all()
+    def _get_post_ids_query(cls, tag_id):
+        """ 按`post_id`倒序正好是`idx_tag_post`的顺序，JOIN只为排除已删除的文章 """
+        return cls.query.with_entities(cls.post_id).join(
+            Post, Post.id == cls.post_id).filter(cls.tag_id == tag_id)
 
-        query = Post.query.filter(Post.id.in_(
-            id for id, in post_ids)).order_by(Post.id.desc())
-        return query
+    @classmethod
+    @cache(MC_KEY_GET_POST_IDS_BY_TAG % ('{identifier}', '{page}'),
+           single_flight=True,
+           namespace=MC_NS_POST_IDS_BY_TAG % '{identifier}')
+    def get_post_ids_by_tag(cls, identifier, page=1):
+        """ `identifier`: tag_id or tag_name，只缓存post id """
+        tag_id = Tag.get_id(identifier)
+        if not tag_id:
+            return []
+        ids = cls._get_post_ids_query(tag_id).order_by(
+            cls.post_id.desc()).limit(PER_PAGE).offset(
+                PER_PAGE * (page - 1))
+        total = int(cls.get_post_count_by_tag(identifier))
+        return Pagination(None, page, PER_PAGE, total, [id for id, in ids])
 
     @classmethod
-    @cache(MC_KEY_GET_POSTS_BY_TAG % ('{identifier}', '{page}'))
     def get_posts_by_tag(cls, identifier, page=1):
-        """ `identifier`: tag_id or tag_name """
-        query = cls._get_posts_by_tag(identifier)
-        if not query:
-            return []
-        posts = query.paginate(page, PER_PAGE)
-        del posts.query  # Fix `TypeError: can't pickle _thread.lock objects`
+        """ `identifier`: tag_id or tag_name，post由`Post.get_multi`批量获取 """
+        posts = cls.get_post_ids_by_tag(identifier, page)
+        if posts:
+            posts.items = Post.get_multi(posts.items)
         return posts
 
     @classmethod
-    @cache(MC_KEY_GET_COUNT_BY_TAG % ('{identifier}'))
+    @cache(MC_KEY_GET_POST_IDS_BY_TAG_CURSOR % '{identifier}',
+           single_flight=True,
+           namespace=MC_NS_POST_IDS_BY_TAG % '{identifier}')
+    def _get_first_post_ids_by_tag_cursor(cls, identifier):
+        return cls._get_post_ids_by_tag_cursor(identifier)
+
+    @classmethod
+    def _get_post_ids_by_tag_cursor(cls, identifier, cursor=None):
+        tag_id = Tag.get_id(identifier)
+        if not tag_id:
+            return None
+        page = keyset_paginate(cls._get_post_ids_query(tag_id),
+                               [cls.post_id], cursor)
+        page.items = [id for id, in page.items]
+        return page
+
+    @classmethod
+    def get_posts_by_tag_cursor(cls, identifier, cursor=None):
+        """ 按post id倒序的游标分页，`total`取自计数缓存 """
+        # 客户端传来的游标不进入缓存key，只缓存第一页
+        page = cls._get_post_ids_by_tag_cursor(identifier, cursor) if cursor \
+            else cls._get_first_post_ids_by_tag_cursor(identifier)
+        if page:
+            page.items = Post.get_multi(page.items)
+            page.total = int(cls.get_post_count_by_tag(identifier))
+        return page
+
+    @classmethod
+    @cache(MC_KEY_GET_COUNT_BY_TAG % ('{identifier}'), single_flight=True)
     def get_post_count_by_tag(cls, identifier):
-        """ identifier`: tag_id or tag_name """
-        query = cls._get_posts_by_tag(identifier)
-        return query.count() if query else 0
+        """ identifier`: tag_id or tag_name，之后由`clear_mc`增减，
+        只有缓存失效时才统计一次，和列表一样JOIN`Post`，不计入已删除的文章 """
+        tag_id = Tag.get_id(identifier)
+        if not tag_id:
+            return 0
+        return cls._get_post_ids_query(tag_id).with_entities(
+            func.count(cls.post_id)).scalar()
 
     @classmethod
     def update_multi(cls, post_id, tags, origin_tags=None):
@@ -210,8 +293,8 @@ class PostTag(db.Model):
     def clear_mc(cls, target, amount):
         tag_id = target.tag_id
         tag_name = Tag.get(tag_id).name
+        buf = mc_buffer(target)
         for ident in (tag_id, tag_name):
-            total = incr_key(MC_KEY_GET_COUNT_BY_TAG % ident, amount)
-            pages = math.ceil(max(total, 1) / PER_PAGE)
-            for p in range(1, pages + 1):
-                rdb.delete(MC_KEY_GET_POSTS_BY_TAG % (ident, p))
+            buf.incr(MC_KEY_GET_COUNT_BY_TAG % ident, amount)
+            buf.bump(MC_NS_POST_IDS_BY_TAG % ident)
+        buf.bump(MC_NS_FRAGMENT % (Post.__name__, target.post_id))  # 卡片上的标签
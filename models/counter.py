@@ -0,0 +1,205 @@
+"""
+like/collect/comment的持久化计数
+
+`ActionMixin.get_count_by_target`的缓存失效后从`action_counters`表读取，
+不再对动作表`COUNT(*)`。事务提交时`ActionMixin.clear_mc`把增量`HINCRBY`到
+`COUNTER_DELTA_KEY`，定时任务`flush_action_counters`分批写入数据库，
+`ActionMixin.reconcile_counters`按块重新统计，修正偏差。
+
+每次写入分配一个递增的代号，写入的行同时记下代号(`flush_id`)：
+中断后重写同一代的增量不会重复累加，读取时也只加上该行还没写入的增量。
+"""
+import time
+from contextlib import contextmanager
+
+from redis.exceptions import ResponseError
+from sqlalchemy import and_, func
+
+from corelib.db import db, rdb, bulk_incr
+from corelib.consts import ONE_MINUTE
+from corelib.utils import generate_id
+
+# 还没写入数据库的增量，field为`action_type:target_id:target_kind`
+COUNTER_DELTA_KEY = 'counter:delta'
+
+# 正在写入数据库的增量，属于`COUNTER_GEN_KEY`这一代
+COUNTER_FLUSHING_KEY = 'counter:delta:flushing'
+
+# 当前(或上一次)写入的代号，只增不减，不设过期
+COUNTER_GEN_KEY = 'counter:delta:gen'
+
+# 写入和对账同一时间只有一个worker执行
+COUNTER_FLUSH_LOCK = 'counter:delta:lock'
+COUNTER_FLUSH_LOCK_TIMEOUT = ONE_MINUTE * 5
+
+COUNTER_KEYS = ('target_id', 'target_kind', 'action_type')
+
+_release_lock = rdb.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+_extend_lock = rdb.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+class ActionCounter(db.Model):
+    """ 对象被 <like|collect|comment> 的数量 """
+    __tablename__ = 'action_counters'
+    target_id = db.Column(db.Integer)
+    target_kind = db.Column(db.Integer)
+    action_type = db.Column(db.String(16))
+    n = db.Column(db.Integer, default=0)
+    # 最后写入这一行的增量代号
+    flush_id = db.Column(db.Integer, nullable=False, default=0,
+                         server_default='0')
+
+    __table_args__ = (
+        db.UniqueConstraint(*COUNTER_KEYS, name='uk_target_action'),
+    )
+
+
+def delta_field(action_type, target_id, target_kind):
+    return '%s:%s:%s' % (action_type, target_id, target_kind)
+
+
+def get_counts(action_type, target_kind, target_ids):
+    """
+    数据库里的计数加上还没写入的增量，没有记录的计数为0。
+    先取增量再查表，按行的`flush_id`判断增量是否已经写入，
+    写入和删除增量之间读到的计数也不会重复
+    """
+    fields = [delta_field(action_type, id, target_kind) for id in target_ids]
+    pipe = rdb.pipeline(transaction=True)
+    pipe.get(COUNTER_GEN_KEY)
+    pipe.hmget(COUNTER_DELTA_KEY, fields)
+    pipe.hmget(COUNTER_FLUSHING_KEY, fields)
+    gen, pending, flushing = pipe.execute()
+    gen = int(gen or 0)
+    c = ActionCounter
+    rows = {id: (n, flush_id) for id, n, flush_id in c.query.with_entities(
+        c.target_id, c.n, c.flush_id).filter(
+            c.target_id.in_(target_ids), c.target_kind == target_kind,
+            c.action_type == action_type)}
+    counts = {}
+    for id, p, f in zip(target_ids, pending, flushing):
+        n, flush_id = rows.get(id, (0, 0))
+        flush_id = flush_id or 0
+        # `flushing`属于第gen代，`pending`会在之后的代写入
+        if flush_id < gen:
+            n += int(f or 0)
+        if flush_id <= gen:
+            n += int(p or 0)
+        counts[id] = n
+    return counts
+
+
+def set_counts(action_type, counts):
+    """ 把`counts`({(target_id, target_kind): n})直接写成对账后的准确值 """
+    table = ActionCounter.__table__
+    for (target_id, target_kind), n in counts.items():
+        r = db.session.execute(table.update().where(and_(
+            table.c.target_id == target_id,
+            table.c.target_kind == target_kind,
+            table.c.action_type == action_type)).values(n=n))
+        if not r.rowcount:
+            db.session.execute(table.insert().values(
+                target_id=target_id, target_kind=target_kind,
+                action_type=action_type, n=n))
+    db.session.commit()
+
+
+def _parse_deltas(items):
+    rows = []
+    for field, delta in items:
+        action_type, target_id, target_kind = field.decode().split(':')
+        if int(delta):
+            rows.append(dict(action_type=action_type, n=int(delta),
+                             target_id=int(target_id),
+                             target_kind=int(target_kind)))
+    # 按唯一键排序，批量upsert时加锁顺序一致
+    return sorted(rows, key=lambda r: tuple(r[k] for k in COUNTER_KEYS))
+
+
+def get_pending_deltas(action_type):
+    """ `action_type`还没写入的增量，{(target_id, target_kind): delta} """
+    deltas = {}
+    for name in (COUNTER_DELTA_KEY, COUNTER_FLUSHING_KEY):
+        for row in _parse_deltas(rdb.hgetall(name).items()):
+            if row['action_type'] == action_type:
+                key = (row['target_id'], row['target_kind'])
+                deltas[key] = deltas.get(key, 0) + row['n']
+    return deltas
+
+
+@contextmanager
+def flush_lock(wait=0):
+    """
+    持有写入锁执行，`wait`秒内拿不到锁时返回`None`，否则返回续期函数，
+    耗时的对账每处理一块调用一次
+    """
+    token = generate_id()
+    deadline = time.time() + wait
+    while not rdb.set(COUNTER_FLUSH_LOCK, token,
+                      ex=COUNTER_FLUSH_LOCK_TIMEOUT, nx=True):
+        if time.time() >= deadline:
+            yield None
+            return
+        time.sleep(0.1)
+    try:
+        yield lambda: _extend_lock(keys=[COUNTER_FLUSH_LOCK],
+                                   args=[token, COUNTER_FLUSH_LOCK_TIMEOUT])
+    finally:
+        _release_lock(keys=[COUNTER_FLUSH_LOCK], args=[token])
+
+
+def _next_gen():
+    if not rdb.exists(COUNTER_GEN_KEY):
+        # 代号丢失时从数据库里最大的代号接着分配
+        last = db.session.query(func.max(ActionCounter.flush_id)).scalar()
+        rdb.set(COUNTER_GEN_KEY, last or 0, nx=True)
+    return rdb.incr(COUNTER_GEN_KEY)
+
+
+def _flush_deltas(batch):
+    if rdb.exists(COUNTER_FLUSHING_KEY):  # 上次中断，沿用同一代接着写
+        gen = int(rdb.get(COUNTER_GEN_KEY) or _next_gen())
+    else:
+        # 先分配代号再改名，读取时改名前的增量也按新一代判断
+        gen = _next_gen()
+        try:
+            rdb.rename(COUNTER_DELTA_KEY, COUNTER_FLUSHING_KEY)
+        except ResponseError:  # 没有新的增量
+            return 0
+    items = list(rdb.hgetall(COUNTER_FLUSHING_KEY).items())
+    total = 0
+    for i in range(0, len(items), batch):
+        chunk = items[i:i + batch]
+        rows = _parse_deltas(chunk)
+        bulk_incr(ActionCounter, COUNTER_KEYS, 'n', rows,
+                  version=('flush_id', gen))
+        db.session.commit()
+        rdb.hdel(COUNTER_FLUSHING_KEY, *(field for field, _ in chunk))
+        total += len(rows)
+    return total
+
+
+def flush_deltas(batch=500, lock=True):
+    """
+    把累积的增量分批写入`action_counters`，返回写入的行数。
+    先把`COUNTER_DELTA_KEY`改名，写入期间的新增量累积到新的hash里；
+    每批提交后才从`COUNTER_FLUSHING_KEY`删除，中断后下次接着写，
+    已经记下这一代的行不会重复累加。已经持有`flush_lock`时传`lock=False`
+    """
+    if not lock:
+        return _flush_deltas(batch)
+    with flush_lock() as locked:
+        if not locked:
+            return 0
+        return _flush_deltas(batch)
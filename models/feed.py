@@ -4,7 +4,9 @@
 
 热门分享feed流-`ACTIVITY_KEY`
 1. 当文章点赞数超过阈值`HOT_THRESHOLD`时， 它就会被放入热门分享的feed流里， 供所有用户查看；
-2. 一段时间后，热门文章会合并到关注者的feed流中，这个动作是由关注者自己产生。
+2. 热门文章会合并到关注者的feed流中，这个动作是由关注者自己读取feed流时产生；
+3. 每次加入热门文章都分配一个递增的序号，关注者记录已合并的最大序号`ACTIVITY_WATERMARK_KEY`，
+   读取时由Lua脚本只合并更新的文章，没有新的热门文章时只比较两个数字。
 
 关注者`follower`的feed流-`FEED_KEY`
 1. 每个关注者`follower`都有自己的feed流；
@@ -12,51 +14,270 @@
 2.2 文章可以有期限，例如300天内（适用于第一次关注），也可以从上次阅读时间到现在（适用于取消再关注）；
 3. 被关注者`followed`新发表一篇文章，他的关注者`followers`都会把文章放入自己的feed流；
 4. 加到feed流时，记录当前的最新的文章ID，作为书签，供以后取消再关注使用，读取书签以后的新文章
+
+分发`fan-out`
+1. 关注者id由`Contact.iter_follower_ids`从关系图分批读取，每批`FANOUT_BATCH`个，一次pipeline写入；
+2. 关注者超过`FANOUT_CHUNK`时，每`FANOUT_CHUNK`个交给一个子任务并行写入，进度记录在`FANOUT_KEY`
+
+推拉结合
+1. 关注者达到`FEED_PUSH_THRESHOLD`的作者加入`CELEBRITIES_KEY`，
+   之后他的文章只写入自己的时间线`TIMELINE_KEY`；
+2. 读取feed时，关注者自己的feed流和他关注的大V的时间线按分数k路归并，重复的文章只保留一个，
+   归并结果缓存`FEED_MERGE_TTL`秒；
+3. 作者一旦成为大V就不会自动退出，避免已经只在时间线里的文章从关注者的feed流中消失
+
+有界的feed流
+1. feed流最多保留`FEED_MAX_LENGTH`篇文章，`FEED_INACTIVE_TTL`内没有读取就过期；
+2. 只往有`FEED_READY_KEY`标记的feed流里写入，不会为不活跃的用户生成不完整的feed流；
+3. 用户回来时先同步查询最多`FEED_REBUILD_SYNC`篇文章渲染首页，再由`rebuild_feed`任务完整重建；
+   重建期间推送的文章写入`FEED_PENDING_KEY`，重建完成时和查询结果一起原子地写入feed流；
+4. 写入feed流的同时在`FEED_AUTHORS_KEY`里记录每篇文章的作者，取消关注时只删除feed流里
+   该作者的文章，耗时只和feed流的长度有关
 """
 
-import math
+import heapq
 from datetime import datetime, timedelta
 
 from flask_sqlalchemy import Pagination
 
-from config import PER_PAGE
+from config import (PER_PAGE, FEED_PUSH_THRESHOLD, FEED_MERGE_TTL,
+                    FEED_MAX_LENGTH, FEED_INACTIVE_TTL, FEED_REBUILD_SYNC)
 from models.user import User
 from models.core import Post
 from models.contact import Contact
-from corelib.consts import ONE_MINUTE
+from corelib.consts import ONE_MINUTE, ONE_DAY
 from corelib.db import rdb
+from corelib.utils import CursorPage, encode_cursor, decode_cursor
+from corelib.mc import cache, delete_mc
 
 DAYS = 300  # 300天内的文章
 MAX = 100
+FANOUT_BATCH = 1000  # 每次读取的关注者数量，也是每个pipeline写入的关注者数量
+# 每个分发子任务处理的关注者数量，要小于`FEED_PUSH_THRESHOLD`，否则推送的
+# 作者关注者都不超过一块，永远不会派发子任务
+FANOUT_CHUNK = max(1, min(FANOUT_BATCH, FEED_PUSH_THRESHOLD - 1))
+TIMELINE_MAX = 1000  # 大V时间线保留的文章数量
+MERGE_LIMIT = 200  # 缓存的推拉合并结果的文章数量，更深的分页临时归并
 
 # from_id 关注者`follower`的feed流，放入各种感兴趣的文章
 FEED_KEY = 'feed:{}'
 
+# from_id feed流完整可用的标记，和feed流同时过期
+FEED_READY_KEY = 'feed:ready:{}'
+
+# from_id feed流里文章的作者，field为post_id，value为author_id，和feed流同时过期
+FEED_AUTHORS_KEY = 'feed:authors:{}'
+
+# from_id 正在重建feed流的标记，避免重复派发重建任务
+FEED_REBUILDING_KEY = 'feed:rebuilding:{}'
+FEED_REBUILD_TIMEOUT = ONE_MINUTE * 5
+
+# from_id 重建期间推送的文章和它们的作者，和重建标记同时过期
+FEED_PENDING_KEY = 'feed:rebuild_pending:{}'
+FEED_PENDING_AUTHORS_KEY = 'feed:rebuild_pending:authors:{}'
+
 # 热门分享，只保留100个，它面向所有用户
 ACTIVITY_KEY = 'feed:activity'
 
-# from_id 热门分享feed流的有效标记，标记失效后会从热门分享重新拉取热门文章合并到关注者的feed流中
-ACTIVITY_UPDATED_KEY = 'feed:activity_updated:{}'
+# 热门分享的文章最近一次加入时的序号，member为post_id，score为序号
+ACTIVITY_SEQ_KEY = 'feed:activity:seq'
+
+# 热门分享的文章的作者，field为post_id，value为author_id
+ACTIVITY_AUTHORS_KEY = 'feed:activity:authors'
+
+# 热门分享最新的序号
+ACTIVITY_COUNTER_KEY = 'feed:activity:counter'
+
+# from_id 已合并到关注者feed流的热门分享的最大序号，和feed流同时过期
+ACTIVITY_WATERMARK_KEY = 'feed:activity_watermark:{}'
 
 # to_id:from_id 文章加入到关注者feed流后，会记录文章ID作为已阅读的书签，它适用于取消再关注的场景
 LAST_VISIT_KEY = 'feed:last_visit_id:{}:{}'
 
+# 不推送文章的大V的用户id集合
+CELEBRITIES_KEY = 'feed:celebrities'
+
+# author_id 大V的文章时间线，分数和`FEED_KEY`一样是负的发表时间
+TIMELINE_KEY = 'feed:timeline:{}'
+
+# from_id 推拉合并后的前`MERGE_LIMIT`个文章id和总数
+MC_KEY_MERGED_FEED = 'feed:get_merged_feed(%s)'
+
+# post_id 文章分发的进度: chunks 已派发的子任务数，done 已完成的子任务数，followers 已写入的关注者数，
+# dispatched 为1表示全部子任务已派发
+FANOUT_KEY = 'feed:fanout:{}'
+
+
+# 截断feed流`KEYS[1]`时同时删除作者索引`KEYS[2]`里的文章，没有过期时间的设为`ttl`
+_TRIM_FEED = """
+local function trim_feed(feed_key, authors_key, max, ttl)
+    local trimmed = redis.call('zrange', feed_key, max, -1)
+    if #trimmed > 0 then
+        redis.call('zremrangebyrank', feed_key, max, -1)
+        for _, id in ipairs(trimmed) do
+            redis.call('hdel', authors_key, id)
+        end
+    end
+    for _, key in ipairs({feed_key, authors_key}) do
+        if redis.call('ttl', key) == -1 then
+            redis.call('expire', key, ttl)
+        end
+    end
+end
+"""
+
+# 只在feed流可用时写入同一作者`ARGV[2]`的文章并截断到`FEED_MAX_LENGTH`，
+# 新建的feed流、作者索引和标记同时过期；正在重建时写入`FEED_PENDING_KEY`
+_add_to_feed = rdb.register_script(_TRIM_FEED + """
+local feed_key, authors_key = KEYS[1], KEYS[3]
+local ttl = redis.call('ttl', KEYS[2])
+if ttl < 0 then
+    ttl = redis.call('ttl', KEYS[4])
+    if ttl < 0 then
+        return false
+    end
+    feed_key, authors_key = KEYS[5], KEYS[6]
+end
+for i = 3, #ARGV, 2 do
+    redis.call('zadd', feed_key, ARGV[i], ARGV[i + 1])
+    redis.call('hset', authors_key, ARGV[i + 1], ARGV[2])
+end
+trim_feed(feed_key, authors_key, tonumber(ARGV[1]), ttl)
+return true
+""")
+
+# 用查询结果`ARGV[3:]`(score, post_id, author_id)替换feed流，并入重建期间
+# 推送的文章，设置可用标记并清除重建标记，推送的文章不会两边都错过
+_finish_rebuild = rdb.register_script(_TRIM_FEED + """
+redis.call('del', KEYS[1], KEYS[2])
+for i = 3, #ARGV, 3 do
+    redis.call('zadd', KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call('hset', KEYS[2], ARGV[i + 1], ARGV[i + 2])
+end
+local pending = redis.call('zrange', KEYS[6], 0, -1, 'withscores')
+for i = 1, #pending, 2 do
+    local author_id = redis.call('hget', KEYS[7], pending[i])
+    if author_id then
+        redis.call('zadd', KEYS[1], pending[i + 1], pending[i])
+        redis.call('hset', KEYS[2], pending[i], author_id)
+    end
+end
+redis.call('del', KEYS[4], KEYS[5], KEYS[6], KEYS[7])
+trim_feed(KEYS[1], KEYS[2], tonumber(ARGV[1]), tonumber(ARGV[2]))
+redis.call('set', KEYS[3], 1, 'EX', ARGV[2])
+return redis.call('zcard', KEYS[1])
+""")
+
+# 删除feed流里作者`ARGV[1]`的文章，返回删除的数量；有文章却没有作者索引时返回-1
+_remove_author_from_feed = rdb.register_script("""
+local index = redis.call('hgetall', KEYS[2])
+if #index == 0 then
+    return redis.call('exists', KEYS[1]) == 1 and -1 or 0
+end
+local n = 0
+for i = 1, #index, 2 do
+    if index[i + 1] == ARGV[1] then
+        redis.call('zrem', KEYS[1], index[i])
+        redis.call('hdel', KEYS[2], index[i])
+        n = n + 1
+    end
+end
+return n
+""")
+
+
+def add_to_feed(from_id, author_id, items, client=None):
+    """
+    `items`: {post_id: score}，都是`author_id`的文章，
+    每次最多写入`FEED_MAX_LENGTH`篇最新的文章
+    """
+    if not items:
+        return
+    items = sorted(items.items(), key=lambda item: item[1])[:FEED_MAX_LENGTH]
+    args = [FEED_MAX_LENGTH, author_id]
+    for post_id, score in items:
+        args.extend((score, post_id))
+    return _add_to_feed(keys=[FEED_KEY.format(from_id),
+                              FEED_READY_KEY.format(from_id),
+                              FEED_AUTHORS_KEY.format(from_id),
+                              FEED_REBUILDING_KEY.format(from_id),
+                              FEED_PENDING_KEY.format(from_id),
+                              FEED_PENDING_AUTHORS_KEY.format(from_id)],
+                        args=args, client=client)
+
+
+_add_activity = rdb.register_script("""
+redis.call('zadd', KEYS[1], ARGV[1], ARGV[2])
+redis.call('hset', KEYS[4], ARGV[2], ARGV[4])
+local trimmed = redis.call('zrange', KEYS[1], tonumber(ARGV[3]), -1)
+if #trimmed > 0 then
+    redis.call('zremrangebyrank', KEYS[1], tonumber(ARGV[3]), -1)
+    for _, id in ipairs(trimmed) do
+        redis.call('zrem', KEYS[2], id)
+        redis.call('hdel', KEYS[4], id)
+    end
+end
+if redis.call('zscore', KEYS[1], ARGV[2]) then
+    redis.call('zadd', KEYS[2], redis.call('incr', KEYS[3]), ARGV[2])
+end
+""")
+
+# 只合并序号大于水位的热门文章，feed流不可用时什么都不做
+_merge_activity = rdb.register_script(_TRIM_FEED + """
+local counter = tonumber(redis.call('get', KEYS[3]) or '0')
+local watermark = tonumber(redis.call('get', KEYS[6]) or '0')
+if counter <= watermark then
+    return 0
+end
+local ttl = redis.call('ttl', KEYS[5])
+if ttl < 0 then
+    return 0
+end
+local ids = redis.call('zrangebyscore', KEYS[2], '(' .. watermark, '+inf')
+for _, id in ipairs(ids) do
+    local score = redis.call('zscore', KEYS[1], id)
+    local author_id = redis.call('hget', KEYS[7], id)
+    if score and author_id then
+        redis.call('zadd', KEYS[4], score, id)
+        redis.call('hset', KEYS[8], id, author_id)
+    end
+end
+trim_feed(KEYS[4], KEYS[8], tonumber(ARGV[1]), ttl)
+redis.call('set', KEYS[6], counter, 'EX', ttl)
+return #ids
+""")
+
 
 class ActivityFeed:
     @staticmethod
-    def add(time, post_id):
-        rdb.zadd(ACTIVITY_KEY, {post_id: -time})  # Fix mapping
-        rdb.zremrangebyrank(ACTIVITY_KEY, MAX, -1)  # 只保留前100个热门文章
+    def add(time, post_id, author_id):
+        """ 只保留前100个热门文章，同时记录这次加入的序号和文章的作者 """
+        _add_activity(keys=[ACTIVITY_KEY, ACTIVITY_SEQ_KEY,
+                            ACTIVITY_COUNTER_KEY, ACTIVITY_AUTHORS_KEY],
+                      args=[-time, post_id, MAX, author_id])
 
     @staticmethod
     def delete(*post_ids):
         if post_ids:
-            rdb.zrem(ACTIVITY_KEY, *post_ids)
+            pipe = rdb.pipeline(transaction=False)
+            pipe.zrem(ACTIVITY_KEY, *post_ids)
+            pipe.zrem(ACTIVITY_SEQ_KEY, *post_ids)
+            pipe.hdel(ACTIVITY_AUTHORS_KEY, *post_ids)
+            pipe.execute()
 
     @staticmethod
     def get_all():
         return rdb.zrange(ACTIVITY_KEY, 0, -1, withscores=True)
 
+    @staticmethod
+    def merge_into(from_id):
+        """ 把关注者还没合并的热门文章合并到他的feed流，返回合并的数量 """
+        return _merge_activity(keys=[
+            ACTIVITY_KEY, ACTIVITY_SEQ_KEY, ACTIVITY_COUNTER_KEY,
+            FEED_KEY.format(from_id), FEED_READY_KEY.format(from_id),
+            ACTIVITY_WATERMARK_KEY.format(from_id), ACTIVITY_AUTHORS_KEY,
+            FEED_AUTHORS_KEY.format(from_id)], args=[FEED_MAX_LENGTH])
+
 
 def get_followed_latest_posts(to_id, from_id):
     user = User.get(to_id)
@@ -79,73 +300,378 @@ def get_followed_latest_posts(to_id, from_id):
     return posts
 
 
-def gen_followers(to_id):
-    user = User.get(to_id)
-    if not user:
-        return []
+def _score(post):
+    return -int(post.created_at.timestamp())
 
-    pages = math.ceil((max(user.n_followers, 0) or 1) / PER_PAGE)
-    for p in range(1, pages + 1):
-        yield Contact.get_followers_paginate(to_id, p).items
+
+def push_post(post_id, author_id, score, from_ids):
+    """ 把文章写入`from_ids`的feed流并更新书签，每`FANOUT_BATCH`个关注者一次pipeline """
+    pipe = rdb.pipeline(transaction=False)
+    for i, from_id in enumerate(from_ids, 1):
+        add_to_feed(from_id, author_id, {post_id: score}, client=pipe)
+        pipe.set(LAST_VISIT_KEY.format(author_id, from_id), post_id)
+        if i % FANOUT_BATCH == 0:
+            pipe.execute()
+    pipe.execute()
 
 
 def feed_followed_posts_to_follower(from_id, to_id):
-    """ 把被关注者`to_id`的文章放入到关注者`from_id`的`FEED_KEY`流中 """
+    """ 把被关注者`to_id`的文章放入到关注者`from_id`的`FEED_KEY`流中，大V的文章读取时再拉取 """
+    if is_celebrity(to_id):
+        delete_mc(MC_KEY_MERGED_FEED % from_id)
+        return
     posts = get_followed_latest_posts(to_id, from_id)
     if not posts:
         return
     items = {post_id: -int(created_at.timestamp()) for post_id, created_at in posts}  # noqa
-    feed_key = FEED_KEY.format(from_id)
-    rdb.zadd(feed_key, items)
+    add_to_feed(from_id, to_id, items)
 
 
 def feed_post_to_followers(post):
-    """ 把文章放入到所有关注了该文章作者的关注者的`FEED_KEY`流中 """
-    to_user = User.get(post.author_id)
-    for from_ids in gen_followers(post.author_id):
-        for from_id in from_ids:
-            feed_key = FEED_KEY.format(from_id)
-            rdb.zadd(feed_key, {post.id: -int(post.created_at.strftime('%s'))})
-            visit_key = LAST_VISIT_KEY.format(to_user.id, from_id)
-            rdb.set(visit_key, post.id)
+    """
+    把文章放入到所有关注了该文章作者的关注者的`FEED_KEY`流中，
+    关注者不超过`FANOUT_CHUNK`时在当前任务里写完，否则按块派发子任务
+    """
+    author = User.get(post.author_id)
+    if not author:
+        return
+    if is_celebrity(author.id) or author.n_followers >= FEED_PUSH_THRESHOLD:
+        add_to_timeline(post)
+        return
+    if author.n_followers <= FANOUT_CHUNK:
+        for from_ids in Contact.iter_follower_ids(post.author_id,
+                                                  FANOUT_BATCH):
+            push_post(post.id, post.author_id, _score(post), from_ids)
+        return
+
+    from handler.tasks import feed_post_to_follower_chunk
+    progress_key = FANOUT_KEY.format(post.id)
+    rdb.delete(progress_key)
+    for from_ids in Contact.iter_follower_ids(post.author_id, FANOUT_CHUNK):
+        pipe = rdb.pipeline(transaction=False)
+        pipe.hincrby(progress_key, 'chunks', 1)
+        pipe.expire(progress_key, ONE_DAY)
+        pipe.execute()
+        feed_post_to_follower_chunk.delay(post.id, post.author_id,
+                                          _score(post), from_ids)
+    rdb.hset(progress_key, 'dispatched', 1)
+
+
+def feed_post_to_follower_chunk(post_id, author_id, score, from_ids):
+    """ 分发子任务，写完一块后更新`FANOUT_KEY`里的进度 """
+    push_post(post_id, author_id, score, from_ids)
+    pipe = rdb.pipeline(transaction=False)
+    progress_key = FANOUT_KEY.format(post_id)
+    pipe.hincrby(progress_key, 'done', 1)
+    pipe.hincrby(progress_key, 'followers', len(from_ids))
+    pipe.expire(progress_key, ONE_DAY)
+    pipe.execute()
+
+
+def get_fanout_progress(post_id):
+    """ 返回`{'chunks', 'done', 'followers', 'dispatched'}`，小规模分发没有进度记录 """
+    progress = rdb.hgetall(FANOUT_KEY.format(post_id))
+    return {k.decode(): int(v) for k, v in progress.items()}
+
+
+def is_celebrity(author_id):
+    return rdb.sismember(CELEBRITIES_KEY, author_id)
+
+
+def add_to_timeline(post):
+    """ 大V的文章只写入他的时间线，不推送给关注者 """
+    key = TIMELINE_KEY.format(post.author_id)
+    pipe = rdb.pipeline(transaction=False)
+    pipe.sadd(CELEBRITIES_KEY, post.author_id)
+    pipe.exists(key)
+    pipe.zadd(key, {post.id: _score(post)})
+    pipe.zremrangebyrank(key, TIMELINE_MAX, -1)
+    if not pipe.execute()[1]:
+        rdb.delete(key)  # 刚成为大V，完整加载他的时间线
+        ensure_timelines([post.author_id])
+
+
+def ensure_timelines(author_ids):
+    """ 不存在的时间线从数据库加载最近`DAYS`天内的`TIMELINE_MAX`篇文章 """
+    pipe = rdb.pipeline(transaction=False)
+    for id in author_ids:
+        pipe.exists(TIMELINE_KEY.format(id))
+    missing = [id for id, exists in zip(author_ids, pipe.execute())
+               if not exists]
+    for author_id in missing:
+        posts = Post.query.with_entities(Post.id, Post.created_at).filter(
+            Post.author_id == author_id, Post.created_at >= (
+                datetime.now() - timedelta(days=DAYS))).order_by(
+                    Post.id.desc()).limit(TIMELINE_MAX).all()
+        if posts:
+            rdb.zadd(TIMELINE_KEY.format(author_id), {
+                id: -int(created_at.timestamp()) for id, created_at in posts})
+
+
+def get_followed_celebrities(from_id):
+    """ `from_id`关注的大V，大V通常不多，逐个检查是否关注 """
+    celebrity_ids = [int(id) for id in rdb.smembers(CELEBRITIES_KEY)]
+    return [id for id, followed in zip(
+        celebrity_ids, Contact.is_following(from_id, celebrity_ids))
+        if followed]
+
+
+def merge_feed(from_id, celebrity_ids, limit):
+    """
+    按分数k路归并关注者自己的feed流和大V的时间线，返回(前`limit`个文章id, 总数)。
+    每个来源最多读取`limit`个，重复的文章只保留一个，总数也减去读到的重复
+    """
+    ensure_timelines(celebrity_ids)
+    keys = [FEED_KEY.format(from_id)] + [
+        TIMELINE_KEY.format(id) for id in celebrity_ids]
+    pipe = rdb.pipeline(transaction=False)
+    for key in keys:
+        pipe.zrange(key, 0, limit - 1, withscores=True)
+        pipe.zcard(key)
+    rs = pipe.execute()
+    sources = [[(score, int(id)) for id, score in items] for items in rs[::2]]
+    total = sum(rs[1::2])
+
+    post_ids, seen = [], set()
+    for _, post_id in heapq.merge(*sources):
+        if post_id in seen:
+            total -= 1
+            continue
+        seen.add(post_id)
+        post_ids.append(post_id)
+        if len(post_ids) == limit:
+            break
+    return post_ids, total
+
+
+@cache(MC_KEY_MERGED_FEED % '{from_id}', expire=FEED_MERGE_TTL)
+def get_merged_feed(from_id):
+    """ 推拉合并后的前`MERGE_LIMIT`个文章id和总数，没有关注大V时为`None` """
+    celebrity_ids = get_followed_celebrities(from_id)
+    if not celebrity_ids:
+        return None
+    return merge_feed(from_id, celebrity_ids, MERGE_LIMIT)
 
 
 def remove_post_from_feed(post_id, author_id):
     """ 删除文章后，也要删除关注者的`FEED_KEY`里对应的文章ID """
-    for from_ids in gen_followers(author_id):
+    ActivityFeed.delete(post_id)
+    rdb.zrem(TIMELINE_KEY.format(author_id), post_id)
+    for from_ids in Contact.iter_follower_ids(author_id, FANOUT_BATCH):
+        pipe = rdb.pipeline(transaction=False)
         for from_id in from_ids:
-            feed_key = FEED_KEY.format(from_id)
-            rdb.zrem(feed_key, post_id)
-            ActivityFeed.delete(post_id)
+            pipe.zrem(FEED_KEY.format(from_id), post_id)
+            pipe.hdel(FEED_AUTHORS_KEY.format(from_id), post_id)
+            pipe.zrem(FEED_PENDING_KEY.format(from_id), post_id)
+        pipe.execute()
 
 
 def remove_user_posts_from_feed(from_id, to_id):
-    """ 取消关注后，也要删除关注者的`FEED_KEY`里所有该作者的文章ID """
-    post_ids = [id for id, in Post.query.with_entities(Post.id).filter(
-        Post.author_id == to_id)]
+    """
+    取消关注后，按`FEED_AUTHORS_KEY`删除关注者的`FEED_KEY`里该作者的文章ID，
+    没有作者索引的旧feed流才查询作者的全部文章
+    """
     feed_key = FEED_KEY.format(from_id)
-    if post_ids:
-        rdb.zrem(feed_key, *post_ids)
+    if _remove_author_from_feed(keys=[
+            feed_key, FEED_AUTHORS_KEY.format(from_id)], args=[to_id]) < 0:
+        post_ids = [id for id, in Post.query.with_entities(Post.id).filter(
+            Post.author_id == to_id)]
+        if post_ids:
+            rdb.zrem(feed_key, *post_ids)
+    delete_mc(MC_KEY_MERGED_FEED % from_id)
+
+
+def recent_post_items(author_ids, limit):
+    """
+    作者们最近`DAYS`天内最新的`limit`篇文章[(score, post_id, author_id)]，
+    每`FANOUT_BATCH`个作者一次查询
+    """
+    since = datetime.now() - timedelta(days=DAYS)
+    items = []
+    for i in range(0, len(author_ids), FANOUT_BATCH):
+        rows = Post.query.with_entities(
+            Post.id, Post.created_at, Post.author_id).filter(
+                Post.author_id.in_(author_ids[i:i + FANOUT_BATCH]),
+                Post.created_at >= since).order_by(Post.id.desc()).limit(limit)
+        items.extend((-int(created_at.timestamp()), id, author_id)
+                     for id, created_at, author_id in rows)
+    return heapq.nsmallest(limit, items)
+
+
+def rebuild_feed(from_id):
+    """
+    从关注列表重建feed流，大V的文章读取时拉取，不写入。
+    先设置重建标记再查询，查询之后推送的文章暂存在`FEED_PENDING_KEY`，
+    由`_finish_rebuild`和查询结果一起原子地替换旧数据
+    """
+    rdb.set(FEED_REBUILDING_KEY.format(from_id), 1, ex=FEED_REBUILD_TIMEOUT)
+    celebrity_ids = {int(id) for id in rdb.smembers(CELEBRITIES_KEY)}
+    author_ids = [id for id in Contact.get_following_ids(from_id)
+                  if id not in celebrity_ids]
+    items = recent_post_items(author_ids, FEED_MAX_LENGTH)
+    args = [FEED_MAX_LENGTH, FEED_INACTIVE_TTL]
+    for item in items:
+        args.extend(item)
+    n = _finish_rebuild(keys=[
+        FEED_KEY.format(from_id), FEED_AUTHORS_KEY.format(from_id),
+        FEED_READY_KEY.format(from_id),
+        ACTIVITY_WATERMARK_KEY.format(from_id),  # 重新合并全部热门文章
+        FEED_REBUILDING_KEY.format(from_id), FEED_PENDING_KEY.format(from_id),
+        FEED_PENDING_AUTHORS_KEY.format(from_id)], args=args)
+    delete_mc(MC_KEY_MERGED_FEED % from_id)
+    return n
+
+
+def backfill_feed_ready(batch=1000):
+    """
+    给上线前已经存在的feed流设置`FEED_READY_KEY`，过期时间和feed流一致，
+    避免活跃用户第一次访问时都要同步重建，返回设置的数量
+    """
+    total = 0
+    keys = []
+    for key in rdb.scan_iter(match=FEED_KEY.format('[0-9]*'), count=batch):
+        if key.decode().split(':', 1)[1].isdigit():
+            keys.append(key)
+        if len(keys) >= batch:
+            total += _mark_feeds_ready(keys)
+            keys = []
+    return total + _mark_feeds_ready(keys)
+
+
+def _mark_feeds_ready(keys):
+    if not keys:
+        return 0
+    pipe = rdb.pipeline(transaction=False)
+    for key in keys:
+        pipe.ttl(key)
+    marks = []  # `SET`在pipeline结果里的位置
+    for key, ttl in zip(keys, pipe.execute()):
+        if ttl == -2:  # 扫描之后过期了
+            continue
+        if ttl == -1:  # 旧的feed流没有过期时间
+            ttl = FEED_INACTIVE_TTL
+            pipe.expire(key, ttl)
+        from_id = key.decode().split(':', 1)[1]
+        pipe.set(FEED_READY_KEY.format(from_id), 1, ex=ttl, nx=True)
+        marks.append(len(pipe) - 1)
+    rs = pipe.execute()
+    return sum(1 for i in marks if rs[i])
+
+
+def touch_feed(from_id):
+    """ 读取时延长feed流的过期时间，返回feed流是否可用 """
+    pipe = rdb.pipeline(transaction=False)
+    pipe.expire(FEED_READY_KEY.format(from_id), FEED_INACTIVE_TTL)
+    pipe.expire(FEED_KEY.format(from_id), FEED_INACTIVE_TTL)
+    pipe.expire(FEED_AUTHORS_KEY.format(from_id), FEED_INACTIVE_TTL)
+    pipe.expire(ACTIVITY_WATERMARK_KEY.format(from_id), FEED_INACTIVE_TTL)
+    return pipe.execute()[0]
+
+
+def get_rebuilding_feed(from_id, page):
+    """
+    feed流不可用时派发重建任务，这期间只用一次有`LIMIT`的查询返回最新的文章，
+    返回(第`page`页, 全部)的[(score, post_id, author_id)]
+    """
+    if rdb.set(FEED_REBUILDING_KEY.format(from_id), 1,
+               ex=FEED_REBUILD_TIMEOUT, nx=True):
+        from handler.tasks import rebuild_feed
+        rebuild_feed.delay(from_id)
+    items = recent_post_items(Contact.get_following_ids(from_id),
+                              FEED_REBUILD_SYNC)
+    return items[(page - 1) * PER_PAGE:page * PER_PAGE], items
 
 
 def get_user_feed(from_id, page):
     """ 获取用户的`FEED_KEY`的文章 """
+    if not touch_feed(from_id):
+        page_items, items = get_rebuilding_feed(from_id, page)
+        posts = Post.get_multi([id for _, id, _ in page_items])
+        Post.prefetch_props(posts)
+        return Pagination(None, page, PER_PAGE, len(items), posts)
+
     feed_key = FEED_KEY.format(from_id)
-    update_key = ACTIVITY_UPDATED_KEY.format(from_id)
-    if not rdb.get(update_key):
-        items = ActivityFeed.get_all()
-        if items:
-            rdb.zadd(feed_key, dict(items))
-        rdb.set(update_key, 1, ex=ONE_MINUTE * 5)
+    ActivityFeed.merge_into(from_id)
     start = (page - 1) * PER_PAGE
     end = start + PER_PAGE - 1
-    post_ids = rdb.zrange(feed_key, start, end)
-    items = Post.get_multi([int(id) for id in post_ids])
-    total = rdb.zcard(feed_key)
+    merged = get_merged_feed(from_id)
+    if merged is None:
+        post_ids = [int(id) for id in rdb.zrange(feed_key, start, end)]
+        total = rdb.zcard(feed_key)
+    else:
+        post_ids, total = merged
+        if end >= len(post_ids) == MERGE_LIMIT:  # 超出缓存的范围
+            post_ids, total = merge_feed(
+                from_id, get_followed_celebrities(from_id), end + 1)
+        post_ids = post_ids[start:end + 1]
+    items = Post.get_multi(post_ids)
+    Post.prefetch_props(items)
     return Pagination(None, page, PER_PAGE, total, items)
 
 
+def _after_cursor(items, score, after_id):
+    """ `items`: [(score, post_id)]，只保留排在游标(`score`, `after_id`)之后的 """
+    if score is None:
+        return items
+    return [(s, id) for s, id in items
+            if s > score or (s == score and id > after_id)]
+
+
+def range_feed(keys, score, after_id, limit):
+    """
+    从`keys`(feed流和大V时间线)里按(score, post_id)顺序读取游标之后的`limit`篇文章，
+    每个来源两条`ZRANGEBYSCORE`: 和游标同分的全部文章，和分数更大的前`limit`篇，
+    同一篇文章只保留一个
+    """
+    pipe = rdb.pipeline(transaction=False)
+    for key in keys:
+        if score is not None:
+            pipe.zrangebyscore(key, score, score, withscores=True)
+        pipe.zrangebyscore(key, '-inf' if score is None else f'({score}',
+                           '+inf', start=0, num=limit, withscores=True)
+    items = set()
+    for rs in pipe.execute():
+        items.update((int(s), int(id)) for id, s in rs)
+    return sorted(_after_cursor(items, score, after_id))[:limit]
+
+
+def get_user_feed_cursor(from_id, cursor=None):
+    """
+    `get_user_feed`的游标分页，游标是上一页最后一篇文章的(score, post_id)，
+    新文章插到feed流前面也不会让后面的分页重复或遗漏；不返回`total`，不需要`ZCARD`。
+    无法解析的游标抛出`ValueError`
+    """
+    values = decode_cursor(cursor)
+    if values is None:
+        score = after_id = None
+    elif len(values) == 2 and all(isinstance(v, int) for v in values):
+        score, after_id = values
+    else:
+        raise ValueError(cursor)
+
+    if not touch_feed(from_id):
+        _, items = get_rebuilding_feed(from_id, 1)
+        items = _after_cursor([(s, id) for s, id, _ in items],
+                              score, after_id)[:PER_PAGE + 1]
+    else:
+        ActivityFeed.merge_into(from_id)
+        celebrity_ids = get_followed_celebrities(from_id)
+        ensure_timelines(celebrity_ids)
+        keys = [FEED_KEY.format(from_id)] + [
+            TIMELINE_KEY.format(id) for id in celebrity_ids]
+        items = range_feed(keys, score, after_id, PER_PAGE + 1)
+
+    next_cursor = None
+    if len(items) > PER_PAGE:
+        items = items[:PER_PAGE]
+        next_cursor = encode_cursor(items[-1])
+    posts = Post.get_multi([id for _, id in items])
+    Post.prefetch_props(posts)
+    return CursorPage(posts, PER_PAGE, next_cursor, cursor)
+
+
 def add_to_activity_feed(post_id):
     """ 把热门文章加入到`ACTIVITY_KEY`流中 """
     post = Post.get(post_id)
-    ActivityFeed.add(int(post.created_at.timestamp()), post_id)
+    ActivityFeed.add(int(post.created_at.timestamp()), post_id,
+                     post.author_id)
@@ -0,0 +1,92 @@
+"""
+文章卡片和评论的HTML片段缓存
+
+`card`和`render_comment`里对所有用户都一样的部分(标题、摘要、作者信息)只渲染一次，
+存进Redis和进程内的L1，key由对象的id和版本号组成。对象更新时`__flush_*_event__`
+递增它的版本号(`MC_NS_FRAGMENT`)，旧片段不会再被读到，等过期后淘汰。
+每个用户不同的部分(是否点赞、收藏、关注和各种计数)在片段里是`slot`占位符，
+渲染时由`fill_slots`用`card_state`的结果填入。
+列表页的视图先调用`prefetch_fragments`，一次`MGET`读取全部片段。
+"""
+from flask import get_template_attribute
+from markupsafe import Markup, escape
+
+from corelib.consts import ONE_DAY, ONE_HOUR
+from corelib.db import rdb
+from corelib.mc import l1_family
+from models.loader import get_loader
+
+# version, macro, objs 片段的HTML，`objs`是`类名:id@版本号`和宏的其他参数
+MC_KEY_FRAGMENT = 'fragment:v%s:%s(%s)'
+FRAGMENT_VERSION = 1  # 宏的HTML改变时加1，上线后不会读到旧的片段
+FRAGMENT_EXPIRE = ONE_DAY  # 不能超过版本号的`NAMESPACE_KEY_EXPIRE`
+FRAGMENT_L1_SIZE = 16 * 1024 * 1024
+
+# 转义后的用户内容里不会出现`<`，占位符不会和内容混淆
+SLOT = '<!--slot:%s-->'
+
+_l1 = l1_family(MC_KEY_FRAGMENT, FRAGMENT_L1_SIZE)
+
+
+def slot(name):
+    """ 模板全局函数，在片段里输出一个占位符 """
+    return Markup(SLOT % name)
+
+
+def _fragment_key(macro, objs, args):
+    versions = get_loader().load_versions(objs)
+    ident = ','.join('%s:%s@%s' % (o.__class__.__name__, o.id, v)
+                     for o, v in zip(objs, versions))
+    return MC_KEY_FRAGMENT % (FRAGMENT_VERSION, macro, ','.join(
+        [ident] + [str(a) for a in args]))
+
+
+def prefetch_fragments(macro, objs_list, *args):
+    """
+    视图在渲染列表前调用，`objs_list`是每次调用`fragment`的`objs`。
+    版本号一次pipeline读取，L1里没有的片段一次`MGET`读取，渲染时不再访问Redis
+    """
+    loader = get_loader()
+    loader.load_versions([o for objs in objs_list for o in objs])
+    keys = [_fragment_key(macro, objs, args) for objs in objs_list]
+    missing = [key for key in dict.fromkeys(keys)
+               if key not in loader.fragments and _l1.get(key) is None]
+    if missing:
+        for key, html in zip(missing, rdb.mget(missing)):
+            loader.fragments[key] = html and html.decode('utf-8')
+
+
+def prefetch_comments(comments):
+    """ 视图在渲染评论列表前调用，评论者和`render_comment`的片段一起批量读取 """
+    get_loader().load_comments(comments)
+    prefetch_fragments('comment_fragment', [(c, c.user) for c in comments])
+
+
+def fragment(macro, objs, *args):
+    """
+    模板全局函数，渲染`_macros.html`里的`macro(*objs, *args)`并缓存，
+    key里有`objs`每个对象的id和版本号，版本号由`Loader`批量读取
+    """
+    key = _fragment_key(macro, objs, args)
+    html = _l1.get(key)
+    if html is None:
+        loader = get_loader()
+        if key in loader.fragments:  # `prefetch_fragments`已经读取过
+            html = loader.fragments[key]
+        else:
+            html = rdb.get(key)
+            html = html and html.decode('utf-8')
+        if html is None:
+            html = str(get_template_attribute('_macros.html', macro)(
+                *objs, *args))
+            rdb.set(key, html, ex=FRAGMENT_EXPIRE)
+        _l1.set(key, html, ONE_HOUR)
+    return Markup(html)
+
+
+def fill_slots(html, **values):
+    """ 模板过滤器，把片段里的占位符换成当前用户的值 """
+    html = str(html)
+    for name, value in values.items():
+        html = html.replace(SLOT % name, str(escape(value)))
+    return Markup(html)
@@ -10,6 +10,7 @@ class LikeItem(ActionMixin, db.Model):
     target_kind = db.Column(db.Integer)
 
     action_type = 'like'
+    track_members = True
 
     __table_args__ = (
         db.Index('idx_ti_tk_ui', target_id, target_kind, user_id),
@@ -18,8 +19,7 @@ class LikeItem(ActionMixin, db.Model):
 
 class LikeMixin:
     def like(self, user_id):
-        item = LikeItem.get_by_target(user_id, self.id, self.kind)
-        if item:
+        if LikeItem.has_member(user_id, self.id, self.kind):
             return False
         ok, _ = LikeItem.create(user_id=user_id, target_id=self.id,
                                 target_kind=self.kind)
@@ -40,4 +40,4 @@ class LikeMixin:
         return int(LikeItem.get_count_by_target(self.id, self.kind))
 
     def is_liked_by(self, user_id):
-        return bool(LikeItem.get_by_target(user_id, self.id, self.kind))
+        return LikeItem.has_member(user_id, self.id, self.kind)
@@ -0,0 +1,142 @@
+"""
+请求内的批量加载器
+
+渲染文章卡片需要作者、点赞/收藏/评论数和当前用户是否点赞、收藏、关注作者，
+逐个读取时每张卡片要访问8次左右缓存。视图把要渲染的文章先交给`prefetch_cards`，
+按类型合并成几次`MGET`/`IN`查询，模板里用`card_state(post)`读取结果。
+同一个请求内重复的作者、文章只加载一次。
+文章和作者的HTML片段版本号(见`models.fragment`)也在这里一起读取。
+"""
+from flask import g, request
+
+from corelib.db import MC_NS_FRAGMENT
+from corelib.mc import namespace_versions
+from corelib.utils import AttrDict
+from models.user import User
+from models.like import LikeItem
+from models.collect import CollectItem
+from models.comment import CommentItem
+from models.contact import Contact, userFollowStats
+
+
+class Loader:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.cards = {}  # (kind, post id) -> AttrDict
+        self.users = {}  # user id -> User
+        self.user_stats = {}  # user id -> AttrDict
+        self.followed = {}  # user id -> 当前用户是否关注
+        self.versions = {}  # `MC_NS_FRAGMENT` -> HTML片段的版本号
+        self.fragments = {}  # `MC_KEY_FRAGMENT` -> 预先读取的片段，没有缓存的为None
+
+    def _load_users(self, ids):
+        ids = list(dict.fromkeys(id for id in ids if id not in self.users))
+        if ids:
+            self.users.update(zip(ids, User.get_multi(ids)))
+
+    def _load_followed(self, ids):
+        ids = list(dict.fromkeys(id for id in ids if id not in self.followed))
+        if not ids:
+            return
+        if not self.user_id:
+            self.followed.update(dict.fromkeys(ids, False))
+            return
+        self.followed.update(zip(ids, Contact.is_following(self.user_id,
+                                                            ids)))
+
+    def load_cards(self, posts):
+        posts = [p for p in posts
+                 if p is not None and (p.kind, p.id) not in self.cards]
+        if not posts:
+            return
+        self._load_users(p.author_id for p in posts)
+        self._load_followed(p.author_id for p in posts)
+
+        by_kind = {}
+        for p in posts:
+            by_kind.setdefault(p.kind, []).append(p)
+        for kind, items in by_kind.items():
+            ids = [p.id for p in items]
+            n_likes = LikeItem.get_count_by_targets(kind, ids)
+            n_comments = CommentItem.get_count_by_targets(kind, ids)
+            n_collects = CollectItem.get_count_by_targets(kind, ids)
+            liked = LikeItem.has_members(self.user_id, kind, ids)
+            collected = CollectItem.has_members(self.user_id, kind, ids)
+            for i, p in enumerate(items):
+                author = self.users.get(p.author_id)
+                p.__dict__['author'] = author  # 预先填充`Post.author`
+                self.cards[(kind, p.id)] = AttrDict(
+                    author=author,
+                    n_likes=int(n_likes[i] or 0),
+                    n_comments=int(n_comments[i] or 0),
+                    n_collects=int(n_collects[i] or 0),
+                    is_liked=liked[i],
+                    is_collected=collected[i],
+                    is_followed=self.followed.get(p.author_id, False))
+        authors = [self.users[id]
+                   for id in dict.fromkeys(p.author_id for p in posts)]
+        self.load_versions(posts + [u for u in authors if u is not None])
+
+    def load_comments(self, comments):
+        """ 评论者一次`get_multi`读取，评论和评论者的片段版本号一次pipeline读取 """
+        self._load_users(c.user_id for c in comments)
+        for c in comments:
+            c.__dict__['user'] = self.users.get(c.user_id)  # 预先填充`user`
+        users = [self.users[id]
+                 for id in dict.fromkeys(c.user_id for c in comments)]
+        self.load_versions(list(comments) +
+                           [u for u in users if u is not None])
+
+    def load_versions(self, objs):
+        """ 对象HTML片段的版本号，一次pipeline读取还没加载的 """
+        nss = [MC_NS_FRAGMENT % (o.__class__.__name__, o.id) for o in objs]
+        missing = list(dict.fromkeys(
+            ns for ns in nss if ns not in self.versions))
+        if missing:
+            self.versions.update(zip(missing, namespace_versions(missing)))
+        return [self.versions[ns] for ns in nss]
+
+    def load_users(self, users):
+        users = [u for u in users
+                 if u is not None and u.id not in self.user_stats]
+        if not users:
+            return
+        ids = [u.id for u in users]
+        counts = userFollowStats.get_counts(ids)
+        self._load_followed(ids)
+        for u, (n_followers, n_following) in zip(users, counts):
+            self.users.setdefault(u.id, u)
+            self.user_stats[u.id] = AttrDict(
+                n_followers=n_followers,
+                n_following=n_following,
+                is_followed=self.followed[u.id])
+
+
+def get_loader():
+    if 'loader' not in g:
+        g.loader = Loader(request.user_id)
+    return g.loader
+
+
+def prefetch_cards(posts):
+    """ 视图在渲染文章列表前调用 """
+    get_loader().load_cards(posts)
+
+
+def prefetch_users(users):
+    """ 视图在渲染用户列表前调用 """
+    get_loader().load_users(users)
+
+
+def card_state(post):
+    """ 模板全局函数，没有预先加载的文章在这里单独加载 """
+    loader = get_loader()
+    loader.load_cards([post])
+    return loader.cards[(post.kind, post.id)]
+
+
+def user_state(user):
+    """ 模板全局函数，没有预先加载的用户在这里单独加载 """
+    loader = get_loader()
+    loader.load_users([user])
+    return loader.user_stats[user.id]
@@ -7,8 +7,7 @@ from elasticsearch.helpers import parallel_bulk
 from elasticsearch.exceptions import ConflictError
 from flask_sqlalchemy import Pagination
 
-from corelib.mc import cache
-from corelib.db import rdb
+from corelib.mc import cache, delete_mc
 
 from config import ES_HOSTS, PER_PAGE
 from corelib.consts import K_POST, ONE_HOUR
@@ -102,7 +101,7 @@ class Item(Document):
 
     @classmethod
     def clear_mc(cls, id, kind):
-        rdb.delete(ITEM_MC_KEY.format(id, kind))
+        delete_mc(ITEM_MC_KEY.format(id, kind))
 
     @classmethod
     def delete(cls, item):
@@ -185,7 +184,8 @@ class Item(Document):
 
     @classmethod
     @cache(POST_IDS_BY_TAG_MC_KEY %
-           ('{tag}', '{page}', '{order_by}', '{per_page}'), ONE_HOUR)
+           ('{tag}', '{page}', '{order_by}', '{per_page}'), ONE_HOUR,
+           single_flight=True, early_refresh=1.0)
     def get_post_ids_by_tag(cls, tag, page, order_by=None, per_page=PER_PAGE):
         """ 只搜索热点post，缓存期为一个小时 """
         s = cls.search()
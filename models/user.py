@@ -3,7 +3,7 @@ from flask_security import UserMixin, RoleMixin
 
 import requests
 
-from corelib.db import db
+from corelib.db import db, mc_buffer, MC_NS_FRAGMENT
 from config import UPLOAD_FOLDER
 from corelib.utils import generate_id
 from models.contact import Contact, userFollowStats
@@ -47,9 +47,20 @@ class User(UserMixin, db.Model):
         db.Index('idx_email', email),
     )
 
+    # 文章卡片和评论的HTML片段里用到的字段
+    fragment_columns = ('name', 'bio', 'avatar_id')
+
     def url(self):
         return '/user/{}'.format(self.id)
 
+    @classmethod
+    def __flush_after_update_event__(cls, target):
+        """ 登录等只更新其他字段时不让片段失效 """
+        super().__flush_after_update_event__(target)
+        attrs = db.inspect(target).attrs
+        if any(attrs[k].history.has_changes() for k in cls.fragment_columns):
+            mc_buffer(target).bump(MC_NS_FRAGMENT % (cls.__name__, target.id))
+
     @property
     def github_id(self):
         return self.github_url.split('/')[-1]
@@ -90,8 +101,8 @@ class User(UserMixin, db.Model):
         return True if contact else False
 
     def is_followed_by(self, user_id):
-        contact = Contact.get_follow_item(user_id, self.id)
-        return bool(contact)
+        return bool(user_id) and Contact.is_following(
+            user_id, [self.id])[0]
 
     @property
     def n_following(self):
@@ -103,8 +114,7 @@ class User(UserMixin, db.Model):
 
     @property
     def _follow_stats(self):
-        stats = userFollowStats.get(self.id)
-        return (stats.follower_count, stats.following_count) if stats else (0, 0)  # noqa
+        return userFollowStats.get_counts([self.id])[0]
 
     def delete(self):
         from models.like import LikeItem
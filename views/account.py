@@ -7,10 +7,22 @@ from models.core import Post
 from models.like import LikeItem
 from models.collect import CollectItem
 from models.contact import Contact
+from models.loader import prefetch_cards, prefetch_users
 from corelib.utils import AttrDict
 
 bp = Blueprint('account', __name__)
 
+# type -> (页码分页, 游标分页)
+PAGE_GETTERS = {
+    'collect': (CollectItem.get_paginate_by_user,
+                CollectItem.get_cursor_page_by_user),
+    'like': (LikeItem.get_paginate_by_user, LikeItem.get_cursor_page_by_user),
+    'following': (Contact.get_following_paginate,
+                  Contact.get_following_cursor_page),
+    'followers': (Contact.get_followers_paginate,
+                  Contact.get_followers_cursor_page),
+}
+
 
 @bp.route('/landing')
 def landing():
@@ -89,14 +101,19 @@ def render_user_page(identifier, renderer, target_cls, type='following',
     if not user:
         abort(404)
     page = request.args.get('page', default=1, type=int)
-    if type == 'collect':
-        p = CollectItem.get_paginate_by_user(user.id, page=page)
-    elif type == 'like':
-        p = LikeItem.get_paginate_by_user(user.id, page=page)
-    elif type == 'following':
-        p = Contact.get_following_paginate(user.id, page=page)
-    elif type == 'followers':
-        p = Contact.get_followers_paginate(user.id, page=page)
+    get_page, get_cursor_page = PAGE_GETTERS[type]
+    if 'cursor' in request.args:  # 游标分页，第一页的`cursor`为空
+        try:
+            p = get_cursor_page(user.id, cursor=request.args['cursor'])
+        except ValueError:
+            abort(400)
+    else:
+        p = get_page(user.id, page=page)
     p.items = target_cls.get_multi(p.items)
+    if target_cls is Post:
+        Post.prefetch_props(p.items)
+        prefetch_cards(p.items)
+    else:
+        prefetch_users(p.items)
     return render_template(renderer, **locals())
 # yapf: enable
@@ -2,12 +2,17 @@ from flask import request, get_template_attribute
 from flask.views import MethodView
 
 from ext import db, security, user_datastore
-from models.core import Post
+from models.core import Post, PostTag
 from models.user import User
+from models.comment import CommentItem
+from models.contact import Contact
+from models.feed import get_user_feed_cursor
+from models.loader import prefetch_cards, card_state
+from models.fragment import fragment, slot, fill_slots
 from . import errors
-from .utils import ApiResult, marshal_with, ApiFlask
+from .utils import ApiResult, marshal, marshal_with, ApiFlask
 from .exceptions import ApiException
-from .schemas import PostSchema, AuthorSchema
+from .schemas import PostSchema, AuthorSchema, CommentSchema, CardSchema
 
 
 def create_app():
@@ -15,6 +20,9 @@ def create_app():
     app.config.from_object('config')  # 但加载`config.py`却是在程序开始运行处
     db.init_app(app)
     security.init_app(app, user_datastore)
+    app.add_template_global(fragment)  # `render_comment`等宏使用
+    app.add_template_global(slot)
+    app.add_template_filter(fill_slots)
 
     return app
 
@@ -135,6 +143,62 @@ class FollowAPI(MethodView):
         return self._merge(user)
 
 
+def cursor_page_result(get_cursor_page, ident, schema, target_cls=None,
+                       cards=False):
+    """ 游标分页的列表接口，`cursor`为空时返回第一页，`cards`为真时返回文章卡片 """
+    try:
+        page = get_cursor_page(ident, cursor=request.args.get('cursor'))
+    except ValueError:
+        raise ApiException(errors.invalid_cursor)
+    if page is None:
+        raise ApiException(errors.not_found)
+    items = page.items
+    if target_cls is not None:
+        items = [i for i in target_cls.get_multi(items) if i is not None]
+    if cards:
+        items = [p for p in items if p is not None]
+        prefetch_cards(items)
+        items = [dict(card_state(p), id=p.id, title=p.title, url=p.url(),
+                      orig_url=p.orig_url, netloc=p.netloc,
+                      abstract_content=p.abstract_content) for p in items]
+    return {'items': marshal(items, schema), 'next_cursor': page.next_cursor,
+            'total': page.total}
+
+
+@json_api.route('/feed')
+def feed():
+    """ 首页feed流的游标分页，卡片状态由`prefetch_cards`批量加载，`total`为空 """
+    if not request.user_id:
+        raise ApiException(errors.access_forbidden)
+    return cursor_page_result(get_user_feed_cursor, request.user_id,
+                              CardSchema(), cards=True)
+
+
+@json_api.route('/post/<int:post_id>/comments')
+def post_comments(post_id):
+    return cursor_page_result(
+        lambda id, cursor: CommentItem.get_cursor_page_by_target(
+            id, Post.kind, cursor), post_id, CommentSchema())
+
+
+@json_api.route('/user/<int:user_id>/followers')
+def user_followers(user_id):
+    return cursor_page_result(Contact.get_followers_cursor_page, user_id,
+                              AuthorSchema(), User)
+
+
+@json_api.route('/user/<int:user_id>/following')
+def user_following(user_id):
+    return cursor_page_result(Contact.get_following_cursor_page, user_id,
+                              AuthorSchema(), User)
+
+
+@json_api.route('/tag/<ident>/posts')
+def tag_posts(ident):
+    return cursor_page_result(PostTag.get_posts_by_tag_cursor, ident.lower(),
+                              PostSchema())
+
+
 for name, view_cls in (('like', LikeAPI), ('comment', CommentAPI),
                        ('collect', CollectAPI)):
     view = view_cls.as_view(name)
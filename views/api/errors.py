@@ -6,3 +6,4 @@ not_found = (1003, 'not found', 404)
 illegal_state = (1004, 'illegal state', 400)
 not_supported = (1005, '暂时不支持此操作', 400)
 post_not_found = (1006, 'Post不存在', 400)
+invalid_cursor = (1007, '无效的分页游标', 400)
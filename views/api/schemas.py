@@ -3,6 +3,7 @@ from marshmallow import Schema, fields
 
 class PostSchema(Schema):
     id = fields.Str()
+    title = fields.Str()
     n_likes = fields.Integer()
     n_comments = fields.Integer()
     n_collects = fields.Integer()
@@ -20,3 +21,28 @@ class AuthorSchema(Schema):
     n_following = fields.Integer()
     n_followers = fields.Integer()
     is_followed = fields.Boolean()
+
+
+class CardSchema(Schema):
+    """ 文章卡片，和`_macros.html`里的`card`显示的内容一样 """
+    id = fields.Str()
+    title = fields.Str()
+    url = fields.Str()
+    orig_url = fields.Str()
+    netloc = fields.Str()
+    abstract_content = fields.Str()
+    author = fields.Nested(AuthorSchema, only=('id', 'name', 'bio',
+                                               'avatar_path'))
+    n_likes = fields.Integer()
+    n_comments = fields.Integer()
+    n_collects = fields.Integer()
+    is_liked = fields.Boolean()
+    is_collected = fields.Boolean()
+    is_followed = fields.Boolean()
+
+
+class CommentSchema(Schema):
+    id = fields.Str()
+    user_id = fields.Str()
+    content = fields.Str()
+    created_at = fields.DateTime()
@@ -6,7 +6,9 @@ from flask_security import login_required
 
 from models.core import Post, Tag, PostTag
 from models.search import Item
-from models.feed import get_user_feed
+from models.feed import get_user_feed, get_user_feed_cursor
+from models.loader import prefetch_cards
+from models.fragment import prefetch_comments
 from config import UPLOAD_FOLDER
 
 bp = Blueprint('index', __name__)
@@ -16,14 +18,24 @@ bp = Blueprint('index', __name__)
 @login_required
 def index():
     page = request.args.get('page', default=1, type=int)
-    posts = get_user_feed(request.user_id, page)
+    if 'cursor' in request.args:  # 游标分页，第一页的`cursor`为空
+        try:
+            posts = get_user_feed_cursor(request.user_id,
+                                         request.args['cursor'])
+        except ValueError:
+            abort(400)
+    else:
+        posts = get_user_feed(request.user_id, page)
+    prefetch_cards(posts.items)
     return render_template('index.html', posts=posts, page=page)
 
 
 @bp.route('/post/<id>/')
 def post(id):
     post = Post.get_or_404(id)
-    return render_template('post.html', post=post)
+    comments = post.get_comments(None)
+    prefetch_comments(comments)
+    return render_template('post.html', post=post, comments=comments)
 
 
 @bp.route('/static/avatars/<path>')
@@ -41,7 +53,13 @@ def tag(ident):
             abort(404)
     page = request.args.get('page', default=1, type=int)
     type = request.args.get('type', default='hot')  # hot/latest
-    if type == 'latest':
+    if type == 'latest' and 'cursor' in request.args:
+        try:
+            posts = PostTag.get_posts_by_tag_cursor(
+                ident, request.args['cursor'])
+        except ValueError:
+            abort(400)
+    elif type == 'latest':
         posts = PostTag.get_posts_by_tag(ident, page)
     elif type == 'hot':
         posts = Item.get_post_ids_by_tag(ident, page, type)  # 从Elasticsearch中查找 # noqa
@@ -49,6 +67,9 @@ def tag(ident):
     else:
         # 未知类型
         posts = []
+    if posts:
+        Post.prefetch_props(posts.items)
+        prefetch_cards(posts.items)
     return render_template('tag.html', tag=tag, ident=ident, posts=posts,
                            type=type)  # 模板能忽略post类型的错误，即使传入posts=[]
 
@@ -58,4 +79,6 @@ def search():
     query = request.args.get('q', '')
     page = request.args.get('page', default=1, type=int)
     posts = Item.new_search(query, page)
+    Post.prefetch_props(posts.items)  # 搜索结果可能包含多种类型的对象
+    prefetch_cards(posts.items)
     return render_template('search.html', query=query, posts=posts)